@@ -0,0 +1,201 @@
+import hashlib
+from collections import Counter
+from datetime import datetime, timezone
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+TOP_N = 5
+# Set on every history record whose contribution is in the rollups. Records
+# saved since rollups exist carry it from the start; older ones get it when a
+# rebuild folds them in
+COUNTED = "rollup_counted"
+# Older records folded in per round of rollup increments during a rebuild
+REBUILD_BATCH_SIZE = 200
+
+def term_id(user_id, kind, label):
+    digest = hashlib.sha256(f"{kind}\0{label}".encode("utf-8")).hexdigest()[:32]
+    return f"{user_id}:{digest}"
+
+class AnalyticsRollups:
+    """
+    Pre-computed dashboard numbers, kept up to date as history is written.
+    analytics_rollups holds one counter document per user; analytics_terms
+    holds per-user question/source counts so the top lists are an indexed
+    find. A user whose rollup was never built (history older than this
+    feature) has the older records folded in once.
+
+    Every record is counted exactly once. New records are inserted with the
+    COUNTED marker and counted by their own increments. A rebuild sets the
+    marker on each older record in one atomic update and counts the state
+    that update returned. Feedback, bookmark and delete increments only
+    apply to records that already carried the marker, so a rebuild racing
+    writes, or another rebuild, neither misses nor repeats a change. A
+    worker that dies mid-rebuild loses at most the last REBUILD_BATCH_SIZE
+    records it had marked but not yet added.
+    """
+
+    def __init__(self, db):
+        self.queries = db["queries"]
+        self.rollups = db["analytics_rollups"]
+        self.terms = db["analytics_terms"]
+
+    def ensure_indexes(self):
+        self.terms.create_index([("user_id", ASCENDING), ("kind", ASCENDING), ("count", DESCENDING)])
+        self.rollups.create_index([("total", DESCENDING)])
+
+    # --- write side -----------------------------------------------------
+
+    def _inc(self, user_id, counters):
+        # Upserts so no increment is dropped; a rollup created this way has
+        # no built_at, and its older records are folded in on its first read
+        counters = {k: v for k, v in counters.items() if v}
+        if not counters:
+            return
+        self.rollups.update_one(
+            {"_id": user_id},
+            {"$inc": counters, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    def _inc_terms(self, user_id, kind, counts):
+        ops = [
+            UpdateOne(
+                {"_id": term_id(user_id, kind, label)},
+                {"$inc": {"count": n}, "$setOnInsert": {"user_id": user_id, "kind": kind, "label": label}},
+                upsert=True
+            )
+            for label, n in counts.items() if n
+        ]
+        if ops:
+            self.terms.bulk_write(ops, ordered=False)
+
+    def record_query(self, user_id, question, sources):
+        self._inc(user_id, {"total": 1})
+        self._inc_terms(user_id, "question", {question: 1})
+        self._inc_terms(user_id, "source", Counter(s.get("source") for s in sources or []))
+
+    def record_feedback(self, before, after):
+        """`before` is the record as it was, with user_id, feedback and the COUNTED marker."""
+        if not before.get(COUNTED):
+            # Not counted yet: the rebuild that counts it will see the new value
+            return
+        old = before.get("feedback")
+        self._inc(before["user_id"], {
+            "helpful": (after == "up") - (old == "up"),
+            "wrong": (after == "down") - (old == "down")
+        })
+
+    def record_bookmark(self, before, after):
+        if before.get(COUNTED):
+            self._inc(before["user_id"], {"bookmarked": bool(after) - bool(before.get("bookmarked"))})
+
+    def record_delete(self, item):
+        if not item.get(COUNTED):
+            return
+        user_id = item["user_id"]
+        self._inc(user_id, {
+            "total": -1,
+            "helpful": -(item.get("feedback") == "up"),
+            "wrong": -(item.get("feedback") == "down"),
+            "bookmarked": -bool(item.get("bookmarked"))
+        })
+        self._inc_terms(user_id, "question", {item["question"]: -1})
+        self._inc_terms(user_id, "source", {
+            label: -n for label, n in Counter(s.get("source") for s in item.get("sources") or []).items()
+        })
+
+    def clear(self, user_id=None):
+        if user_id is None:
+            self.rollups.delete_many({})
+            self.terms.delete_many({})
+        else:
+            self.rollups.delete_one({"_id": user_id})
+            self.terms.delete_many({"user_id": user_id})
+
+    # --- read side ------------------------------------------------------
+
+    def _count_legacy(self, record_id):
+        """
+        Atomically marks one record counted and returns it as it was then,
+        or None if a history write, a delete or another rebuild got there first.
+        """
+        return self.queries.find_one_and_update(
+            {"_id": record_id, COUNTED: {"$exists": False}},
+            {"$set": {COUNTED: True}},
+            projection={"question": 1, "sources.source": 1, "feedback": 1, "bookmarked": 1}
+        )
+
+    def rebuild(self, user_id):
+        """
+        Folds the user's history from before rollups existed (records without
+        the counted marker) into their rollup, then marks it built.
+        """
+        legacy = self.queries.find({"user_id": user_id, COUNTED: {"$exists": False}}, {"_id": 1})
+        counters, questions, sources = Counter(), Counter(), Counter()
+
+        def flush():
+            self._inc(user_id, dict(counters))
+            self._inc_terms(user_id, "question", questions)
+            self._inc_terms(user_id, "source", sources)
+            for pending in (counters, questions, sources):
+                pending.clear()
+
+        for i, item in enumerate(legacy, start=1):
+            record = self._count_legacy(item["_id"])
+            if record is None:
+                continue
+            counters.update({
+                "total": 1,
+                "helpful": record.get("feedback") == "up",
+                "wrong": record.get("feedback") == "down",
+                "bookmarked": bool(record.get("bookmarked"))
+            })
+            questions[record["question"]] += 1
+            sources.update(s.get("source") for s in record.get("sources") or [] if s.get("source") is not None)
+            if i % REBUILD_BATCH_SIZE == 0:
+                flush()
+        flush()
+
+        now = datetime.now(timezone.utc)
+        self.rollups.update_one(
+            {"_id": user_id},
+            {"$set": {"built_at": now, "updated_at": now}},
+            upsert=True
+        )
+        return self.rollups.find_one({"_id": user_id}) or {}
+
+    def top_terms(self, user_id, kind, limit=TOP_N):
+        cursor = self.terms.find(
+            {"user_id": user_id, "kind": kind, "count": {"$gt": 0}},
+            {"label": 1, "count": 1}
+        ).sort("count", DESCENDING).limit(limit)
+        return [{"_id": t["label"], "count": t["count"]} for t in cursor]
+
+    def summary(self, user_id):
+        rollup = self.rollups.find_one({"_id": user_id})
+        if rollup is None or "built_at" not in rollup:
+            rollup = self.rebuild(user_id)
+        total = rollup.get("total", 0)
+        wrong = rollup.get("wrong", 0)
+        return {
+            "total": total,
+            "helpful": rollup.get("helpful", 0),
+            "wrong": wrong,
+            "bookmarked": rollup.get("bookmarked", 0),
+            "hallucination_rate": round((wrong / total) * 100, 2) if total else 0,
+            "top_questions": self.top_terms(user_id, "question"),
+            "top_sources": self.top_terms(user_id, "source")
+        }
+
+    def top_users(self, limit=10):
+        cursor = self.rollups.find({}, {"total": 1}).sort("total", DESCENDING).limit(limit)
+        return [{"_id": r["_id"], "count": r["total"]} for r in cursor]
+
+    def rebuild_all(self):
+        """Builds every rollup that hasn't been built yet."""
+        for user_id in self.queries.distinct("user_id"):
+            self.rebuild(user_id)
+
+if __name__ == "__main__":
+    # One-off backfill so admin top-users includes history from before rollups existed
+    from db import get_db
+    AnalyticsRollups(get_db()).rebuild_all()
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from utils.cache import LRUCache
+
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "600"))
+# Cosine similarity above which a differently-worded question counts as the same one
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+# Bounded twice: answers kept per (user, mode, strict) scope, and scopes kept per worker
+ANSWER_CACHE_PER_SCOPE = int(os.getenv("ANSWER_CACHE_PER_SCOPE", "50"))
+ANSWER_CACHE_SCOPES = int(os.getenv("ANSWER_CACHE_SCOPES", "1000"))
+
+def normalize_question(question):
+    return " ".join(question.lower().split()).strip(" ?!.")
+
+class AnswerKey:
+    """Everything an answer depends on, captured before retrieval runs."""
+
+    def __init__(self, user_id, question, mode, strict):
+        self.scope = (user_id, mode, bool(strict))
+        self.question = question
+        self.normalized = normalize_question(question)
+        # Imported here: keys are only made on the question path, which loads the retrieval stack anyway
+        from rag_utils import SEARCH_SHARED
+        from utils.vectorstore import get_shards
+
+        # Captured up front so an answer built from an index that changes
+        # mid-request is stored against the old generation, not the new one
+        shards = get_shards()
+        self.generation = (
+            shards.generation(user_id),
+            shards.generation(None) if SEARCH_SHARED else None,
+        )
+        self._embedding = None
+
+    @property
+    def embedding(self):
+        if self._embedding is None:
+            from utils.embeddings import get_embeddings
+            vector = np.asarray(get_embeddings().embed_query(self.question), dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            self._embedding = vector / norm if norm else vector
+        return self._embedding
+
+class _Scope:
+    def __init__(self, generation):
+        self.generation = generation
+        # normalized question -> (expires_at, unit embedding, result)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+class AnswerCache:
+    """
+    Per-user answer cache in front of generate_answer.
+    Exact hits match on normalized question text; near hits match on cosine
+    similarity of question embeddings. A scope is wiped as soon as the
+    user's index generation changes, so answers never outlive the notes they
+    were built from.
+    """
+
+    def __init__(self, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_SIMILARITY,
+                 per_scope=ANSWER_CACHE_PER_SCOPE, scopes=ANSWER_CACHE_SCOPES):
+        self.ttl = ttl
+        self.threshold = threshold
+        self.per_scope = per_scope
+        self._scopes = LRUCache(scopes)
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def key(self, user_id, question, mode, strict):
+        return AnswerKey(user_id, question, mode, strict)
+
+    def _scope(self, key, create=False):
+        scope = self._scopes.get(key.scope)
+        if scope is not None and scope.generation != key.generation:
+            self._scopes.pop(key.scope)
+            scope = None
+        if scope is None and create:
+            scope = _Scope(key.generation)
+            self._scopes.set(key.scope, scope)
+        return scope
+
+    def get(self, key):
+        scope = self._scope(key)
+        if scope is None:
+            self.misses += 1
+            return None
+
+        now = time.monotonic()
+        with scope.lock:
+            for question in [q for q, (exp, _, _) in scope.entries.items() if exp < now]:
+                del scope.entries[question]
+
+            entry = scope.entries.get(key.normalized)
+            if entry is not None:
+                scope.entries.move_to_end(key.normalized)
+                self.exact_hits += 1
+                return entry[2]
+
+            if not scope.entries:
+                self.misses += 1
+                return None
+            questions = list(scope.entries)
+            matrix = np.vstack([scope.entries[q][1] for q in questions])
+
+        # Embedding happens outside the lock (it may call the model)
+        scores = matrix @ key.embedding
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            with scope.lock:
+                entry = scope.entries.get(questions[best])
+            if entry is not None:
+                self.near_hits += 1
+                return entry[2]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        scope = self._scope(key, create=True)
+        embedding = key.embedding
+        with scope.lock:
+            scope.entries[key.normalized] = (time.monotonic() + self.ttl, embedding, result)
+            scope.entries.move_to_end(key.normalized)
+            while len(scope.entries) > self.per_scope:
+                scope.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "scopes": len(self._scopes),
+        }
+
+_answer_cache = AnswerCache() if ANSWER_CACHE else None
+
+def get_answer_cache():
+    return _answer_cache
@@ -1,67 +1,191 @@
+import time
+_import_started = time.perf_counter()
+
 import jwt
-from flask import Flask, request, jsonify
-from rag_engine import generate_answer
-from pymongo import MongoClient
+import json
+from flask import Flask, request, jsonify, Response, stream_with_context, send_file, g
+from answer_cache import get_answer_cache
+from pymongo import ASCENDING, DESCENDING, TEXT, InsertOne
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 import os
-from ingest import ingest_document
+import re
+import hashlib
+import sys
+import threading
+import uuid
 from bson import ObjectId
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-from io import BytesIO
+from bson.errors import InvalidId
+from export import stream_history_pdf, export_history_job, export_path
 import bcrypt
-from auth import create_token, verify_token
+from auth import create_token, verify_token, get_role, invalidate_role
+from jobs import JobQueue
+from rate_limit import get_rate_limiter
+from analytics import COUNTED, AnalyticsRollups
+from chunk_store import ChunkStore
+from db import LazyDatabase, get_write_buffer, history_write_concern
+from utils.metrics import (
+    REGISTRY, SERVER_TIMING, timed, count, http_seconds,
+    start_request, request_stages, server_timing_header
+)
+from utils.embedding_cache import get_embedding_cache
+from utils.ocr_cache import get_ocr_cache
+
+# The retrieval stack (rag_engine: LangChain, FAISS, Groq) and the ingest
+# stack (parsers, OCR) are imported inside the routes that use them, so a
+# worker that only serves history, auth or analytics never loads them.
+# `python -m utils.import_profile app` shows what is left at boot.
 
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 app = Flask(__name__)
-CORS(app)
+# Expose the history paging cursor to the browser
+CORS(app, expose_headers=["X-Next-Cursor", "Server-Timing"])
 
-MONGO_URI = os.getenv("MONGO_URI")
-if not MONGO_URI:
-    raise RuntimeError("MONGO_URI missing")
-
-mongo_client = MongoClient(
-    MONGO_URI, 
-    serverSelectionTimeoutMS=5000, # 5 seconds
-    connectTimeoutMS=10000,        # 10 seconds
-    directConnection=False
-)
-db = mongo_client["chatbot"]
+# One pooled client per process, shared with ingest, jobs and the caches (see db.py).
+# Collections are resolved on first use, so importing the app builds no client
+db = LazyDatabase()
 queries = db["queries"]
+# History inserts use HISTORY_WRITE_CONCERN; everything else keeps the client default
+history = queries.with_options(write_concern=history_write_concern())
 users = db["users"]
 rate_limits = db["rate_limits"]
+raw_docs = db["raw_docs"]
 
+# Dashboard counters, updated as history is written instead of aggregated per load
+analytics_rollups = AnalyticsRollups(db)
 
+# Retrieved chunk text, stored once per distinct chunk and referenced by id from history
+chunk_store = ChunkStore(db["chunks"])
 
-RATE_LIMIT = 20
-WINDOW_SECONDS = 60
+# Uploads are ingested in the background; job status is kept in MongoDB
+job_queue = JobQueue(db["jobs"])
 
-def check_rate_limit(user_id):
-    now = datetime.now(timezone.utc)
-    window_start = now - timedelta(seconds=WINDOW_SECONDS)
 
-    # Remove old entries
-    rate_limits.delete_many({
-        "user_id": user_id,
-        "timestamp": {"$lt": window_start}
-    })
 
-    count = rate_limits.count_documents({"user_id": user_id})
+# In-process sliding window or one atomic MongoDB update per request (RATE_LIMIT_BACKEND)
+rate_limiter = get_rate_limiter(rate_limits)
 
-    if count >= RATE_LIMIT:
-        return False
+def ensure_indexes():
+    """Creates the indexes the hot queries rely on. Idempotent; see ensure_indexes_once."""
+    rate_limiter.ensure_indexes()
+    analytics_rollups.ensure_indexes()
+    job_queue.ensure_indexes()
 
-    rate_limits.insert_one({
-        "user_id": user_id,
-        "timestamp": now
-    })
+    # Ranked history search. Only one text index is allowed per collection; the
+    # user_id prefix keeps each $text query inside one tenant's records
+    queries.create_index(
+        [("user_id", ASCENDING), ("question", TEXT), ("text", TEXT), ("sources.source", TEXT)],
+        name="history_text_by_user",
+        weights={"question": 10, "sources.source": 5, "text": 1}
+    )
+    # Exact-question lookups and deletes
+    queries.create_index([("user_id", ASCENDING), ("question_hash", ASCENDING)])
+
+    # History pages (keyset on created_at with _id as tie-breaker) and analytics counts
+    queries.create_index([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)])
+    queries.create_index([("user_id", ASCENDING), ("feedback", ASCENDING)])
+    queries.create_index([("user_id", ASCENDING), ("bookmarked", ASCENDING)])
+
+# Not run at import: an unreachable MongoDB would stall worker boot for the
+# whole server-selection timeout. The first request of each worker does it
+# instead (retried a minute later if MongoDB was down), and deploys can run
+# `flask --app app ensure-indexes` ahead of time.
+INDEX_RETRY_SECONDS = 60
+_indexes_checked_at = None
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+@app.before_request
+def ensure_indexes_once():
+    global _indexes_checked_at, _indexes_ready
+    if _indexes_ready:
+        return
+    with _indexes_lock:
+        now = time.monotonic()
+        if _indexes_ready or (_indexes_checked_at and now - _indexes_checked_at < INDEX_RETRY_SECONDS):
+            return
+        _indexes_checked_at = now
+        try:
+            ensure_indexes()
+            _indexes_ready = True
+        except Exception as e:
+            print(f"Could not create MongoDB indexes: {e}")
 
-    return True
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    ensure_indexes()
+    print("MongoDB indexes are up to date")
+
+def check_rate_limit(user_id):
+    with timed("rate_limit"):
+        allowed = rate_limiter.allow(user_id)
+    if not allowed:
+        count("rate_limited")
+    return allowed
+
+# --- Metrics: per-stage histograms, counters and an optional Server-Timing header ---
+
+# Set to require "Authorization: Bearer <METRICS_TOKEN>" on /metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+@app.before_request
+def start_timing():
+    g.request_started = time.perf_counter()
+    start_request()
+
+@app.after_request
+def record_timing(response):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        http_seconds.observe(
+            time.perf_counter() - started,
+            endpoint=request.endpoint or "unknown",
+            method=request.method,
+            status=response.status_code
+        )
+    # Streamed responses only include the stages finished before the first byte
+    if SERVER_TIMING and request_stages():
+        response.headers["Server-Timing"] = server_timing_header(request_stages())
+    return response
+
+def cache_metrics():
+    samples = []
+    answer_cache = get_answer_cache()
+    if answer_cache:
+        stats = answer_cache.stats()
+        for result in ("exact_hits", "near_hits", "misses"):
+            samples.append(("answer_cache_lookups_total", "counter", "Answer cache lookups by result", stats[result], {"result": result}))
+    embedding_cache = get_embedding_cache()
+    if embedding_cache:
+        stats = embedding_cache.stats()
+        for result in ("memory_hits", "disk_hits", "misses"):
+            samples.append(("embedding_cache_lookups_total", "counter", "Embedding cache lookups by result", stats[result], {"result": result}))
+    ocr_cache = get_ocr_cache()
+    if ocr_cache:
+        stats = ocr_cache.stats()
+        for result in ("hits", "misses"):
+            samples.append(("ocr_cache_lookups_total", "counter", "OCR cache lookups by result", stats[result], {"result": result}))
+    # Read only once a request has loaded the index; importing it here would undo the lazy load
+    vectorstore = sys.modules.get("utils.vectorstore")
+    shard_bytes = vectorstore.get_shards().resident_bytes() if vectorstore else 0
+    samples.append(("vector_shards_resident_bytes", "gauge", "Private memory held by loaded index shards", shard_bytes, {}))
+    writes = get_write_buffer()
+    if writes:
+        samples.append(("history_writes_pending", "gauge", "History writes queued but not yet applied", writes.pending(), {}))
+        samples.append(("history_write_errors_total", "counter", "Buffered history writes that failed", writes.errors, {}))
+    samples.append(("app_import_seconds", "gauge", "Time this worker spent importing app.py", STARTUP_SECONDS, {}))
+    return samples
+
+REGISTRY.register_collector(cache_metrics)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 
 def require_auth(fn):
@@ -99,10 +223,8 @@ def require_auth(fn):
 
 def require_admin(fn):
     def wrapper(*args, **kwargs):
-        uid = request.user_id
-        user = users.find_one({"_id": ObjectId(uid)})
-
-        if not user or user.get("role") != "admin":
+        # Cached per worker; promote() invalidates it
+        if get_role(users, request.user_id) != "admin":
             return jsonify({"error": "Admin access required"}), 403
 
         return fn(*args, **kwargs)
@@ -158,6 +280,60 @@ def login():
     return jsonify({"token": token})
 
 
+GREETINGS = {"hi", "hello", "hey", "hai", "hii"}
+GREETING_RESPONSE = {
+    "text": "Hi! 👋 How can I help you?",
+    "confidence": "Greeting",
+    "coverage": {"grounded": 0, "general": 0},
+    "chunks": []
+}
+
+def question_hash(question):
+    """Exact-question key, case- and whitespace-insensitive like the old ^q$ regex with /i."""
+    normalized = " ".join(question.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def find_question(user_id, question):
+    item = queries.find_one({"user_id": user_id, "question_hash": question_hash(question)})
+    if item is None:
+        # Records saved before question_hash existed: escaped anchored match, then backfill the hash
+        item = queries.find_one({
+            "user_id": user_id,
+            "question_hash": {"$exists": False},
+            "question": {"$regex": f"^{re.escape(question)}$", "$options": "i"}
+        })
+        if item:
+            queries.update_one({"_id": item["_id"]}, {"$set": {"question_hash": question_hash(question)}})
+    return item
+
+def save_query(user_id, question, result):
+    """Persists one answered question to history and returns its id."""
+    record = {
+        "user_id": user_id,
+        "question": question,
+        "question_hash": question_hash(question),
+        "text": result["text"],
+        "confidence": result.get("confidence", ""),
+        "coverage": result.get("coverage", 0),
+        "sources": result.get("sources", []),
+        "created_at": datetime.now(timezone.utc),
+        # Counted by record_query below, so a rollup rebuild skips it
+        COUNTED: True
+    }
+    # HISTORY_WRITES=buffered: queue everything and answer without waiting on MongoDB
+    writes = get_write_buffer()
+    with timed("save_query"):
+        record["chunk_ids"] = chunk_store.save(result.get("chunks", []), writes)
+        if writes:
+            # Client-side id, so the response can reference a record not written yet
+            record["_id"] = ObjectId()
+            writes.write(history, InsertOne(record))
+            writes.call(analytics_rollups.record_query, user_id, question, record["sources"])
+            return str(record["_id"])
+        res = history.insert_one(record)
+        analytics_rollups.record_query(user_id, question, record["sources"])
+    return str(res.inserted_id)
+
 @app.route("/api/ask", methods=["POST"])
 @require_auth
 def ask():
@@ -176,52 +352,155 @@ def ask():
     if not q:
         return jsonify({"error": "Question is required"}), 400
 
-    greetings = {"hi", "hello", "hey", "hai", "hii"}
-    if q.lower() in greetings:
-        return jsonify({
-            "text": "Hi! 👋 How can I help you?",
-            "confidence": "Greeting",
-            "coverage": {"grounded": 0, "general": 0},
-            "raw_retrieval": []
-        })
+    if q.lower() in GREETINGS:
+        return jsonify(GREETING_RESPONSE)
 
     try:
-        result = generate_answer(q, mode, memory, strict, user_id=request.user_id)
+        # Repeated (or near-identical) questions skip retrieval and the LLM entirely
+        answer_cache = get_answer_cache()
+        cache_key = answer_cache.key(request.user_id, q, mode, strict) if answer_cache else None
+        with timed("answer_cache"):
+            result = answer_cache.get(cache_key) if answer_cache else None
+        cached = result is not None
+
+        if not cached:
+            from rag_engine import generate_answer
+            result = generate_answer(q, mode, memory, strict, user_id=request.user_id)
+            if answer_cache and result.get("chunks"):
+                answer_cache.put(cache_key, result)
         
         # RECORD TO DB
-        record = {
-            "user_id": request.user_id,
-            "question": q,
-            "text": result["text"],
-            "confidence": result.get("confidence", ""),
-            "coverage": result.get("coverage", 0),
-            "sources": result.get("sources", []),
-            "chunks": result.get("chunks", []), # Use the chunks from result!
-            "created_at": datetime.now(timezone.utc)
-        }
-        res = queries.insert_one(record)
+        query_id = save_query(request.user_id, q, result)
 
         # THE FIX: Return directly from the result object to ensure synchronization
         return jsonify({
-            "id": str(res.inserted_id),
+            "id": query_id,
             "text": result["text"],
             "confidence": result.get("confidence", "Unknown"),
             "coverage": result.get("coverage", {"grounded": 0, "general": 100}),
             "sources": result.get("sources", []),
-            "raw_retrieval": result.get("raw_retrieval", []), # This is cleaned in rag_engine
-            "chunks": result.get("chunks", [])
+            "chunks": result.get("chunks", []),
+            "cached": cached,
+            "spans": result.get("spans", []),
+            "timings": {} if cached else result.get("timings", {}),
+            "context": result.get("context", {})
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route("/api/ask/stream", methods=["POST"])
+@require_auth
+def ask_stream():
+    """
+    Server-Sent Events version of /api/ask:
+    "sources" once retrieval is done, "token" per LLM delta, then "done"
+    with confidence, coverage and the saved history id.
+    """
+    if not check_rate_limit(request.user_id):
+        return jsonify({"error": "Rate limit exceeded."}), 429
+
+    data = request.json or {}
+    q = data.get("question", "").strip()
+    mode = data.get("mode", "Detailed")
+    memory = data.get("memory", [])
+    strict = data.get("strict", True)
+    user_id = request.user_id
+
+    if not q:
+        return jsonify({"error": "Question is required"}), 400
+
+    def events():
+        if q.lower() in GREETINGS:
+            yield sse("token", {"text": GREETING_RESPONSE["text"]})
+            yield sse("done", GREETING_RESPONSE)
+            return
+
+        try:
+            answer_cache = get_answer_cache()
+            cache_key = answer_cache.key(user_id, q, mode, strict) if answer_cache else None
+            with timed("answer_cache"):
+                result = answer_cache.get(cache_key) if answer_cache else None
+            cached = result is not None
+
+            if cached:
+                yield sse("sources", {"sources": result.get("sources", []), "chunks": result.get("chunks", [])})
+                yield sse("token", {"text": result["text"]})
+            else:
+                from rag_engine import stream_answer
+                for event, payload in stream_answer(q, mode, memory, strict, user_id=user_id):
+                    if event == "result":
+                        result = payload
+                    else:
+                        yield sse(event, payload)
+                if answer_cache and result.get("chunks"):
+                    answer_cache.put(cache_key, result)
+
+            query_id = save_query(user_id, q, result)
+            yield sse("done", {
+                "id": query_id,
+                "text": result["text"],
+                "confidence": result.get("confidence", "Unknown"),
+                "coverage": result.get("coverage", {"grounded": 0, "general": 100}),
+                "sources": result.get("sources", []),
+                "cached": cached,
+                "timings": {} if cached else result.get("timings", {}),
+                "context": result.get("context", {})
+            })
+        except Exception as e:
+            yield sse("error", {"error": str(e)})
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # Keep proxies from buffering the stream
+    })
     
+HISTORY_PAGE_SIZE = 50
+
+def encode_history_cursor(item):
+    millis = int(item["created_at"].replace(tzinfo=timezone.utc).timestamp() * 1000)
+    return f"{millis}_{item['_id']}"
+
+def decode_history_cursor(cursor):
+    millis, last_id = cursor.split("_", 1)
+    created_at = datetime.fromtimestamp(int(millis) / 1000, tz=timezone.utc)
+    return created_at, ObjectId(last_id)
+
 @app.route("/api/history", methods=["GET"])
 @require_auth
 def get_history():
+    """
+    Newest-first history, one page at a time.
+    Pass the X-Next-Cursor header from the previous page as ?cursor= to get
+    the next one; every page is an index range scan, however long the
+    history is. Retrieved chunks are left out unless ?include=chunks.
+    """
+    limit = min(max(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 1), HISTORY_PAGE_SIZE)
+    filters = {"user_id": request.user_id}
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            created_at, last_id = decode_history_cursor(cursor)
+        except (ValueError, TypeError, InvalidId):
+            return jsonify({"error": "Invalid cursor"}), 400
+        filters["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": last_id}}
+        ]
+
+    include_chunks = request.args.get("include") == "chunks"
+    projection = None if include_chunks else {"chunks": 0, "chunk_ids": 0}
     data = list(
-        queries.find({"user_id": request.user_id})
-        .sort("created_at", -1)
-        .limit(50)
+        queries.find(filters, projection)
+        .sort([("created_at", -1), ("_id", -1)])
+        .limit(limit)
     )
+    if include_chunks:
+        chunk_store.hydrate(data)
+    next_cursor = encode_history_cursor(data[-1]) if len(data) == limit else None
 
     # convert ObjectId to string for JSON
     for item in data:
@@ -238,7 +517,8 @@ def get_history():
                 "general": 100 - item["coverage"]
             }
 
-    return jsonify(data)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    return jsonify(data), 200, headers
 
 @app.route("/api/history/id/<id>", methods=["GET"])
 @require_auth
@@ -247,42 +527,59 @@ def get_history_by_id(id):
         item = queries.find_one({"_id": ObjectId(id), "user_id": request.user_id}, {"_id": 0})
         if not item:
             return jsonify({"error": "Not found"}), 404
-        return jsonify(item)
+        return jsonify(chunk_store.hydrate([item])[0])
     except:
         return jsonify({"error": "Invalid id"}), 400
     
 @app.route("/api/history/<question>", methods=["GET"])
 @require_auth
 def get_history_item(question):
-    item = queries.find_one({
-        "question": {"$regex": f"^{question}$", "$options": "i"},
-        "user_id": request.user_id
-    }, {"_id": 0})
+    item = find_question(request.user_id, question)
     
     if not item:
         return jsonify({"error": "Not found"}), 404
 
+    item.pop("_id", None)
     if isinstance(item.get("coverage"), int):
         item["coverage"] = {"grounded": item["coverage"], "general": 100 - item["coverage"]}
 
-    return jsonify(item)
+    return jsonify(chunk_store.hydrate([item])[0])
+
+SEARCH_PAGE_SIZE = 50
 
 @app.route("/api/history/search", methods=["GET"])
 @require_auth
 def search_history():
+    """
+    Ranked full-text search over question, answer and source names (text index).
+    ?page=N pages through results; ?mode=substring keeps the old
+    partial-word matching for queries like "GA" that the text index can't answer
+    (the UI falls back to it for short queries and when ranked search finds nothing).
+    """
     q = request.args.get("q", "").strip()
+    page = max(request.args.get("page", 1, type=int), 1)
+    limit = min(max(request.args.get("limit", SEARCH_PAGE_SIZE, type=int), 1), SEARCH_PAGE_SIZE)
 
     if not q:
         return jsonify([])
 
-    results = list(queries.find({
-        "user_id": request.user_id,
-        "$or": [
-            {"question": {"$regex": q, "$options": "i"}},
-            {"text": {"$regex": q, "$options": "i"}},
-            {"sources.source": {"$regex": q, "$options": "i"}}
-        ]
-    }).sort("created_at", -1).limit(50))
+    if request.args.get("mode") == "substring":
+        pattern = {"$regex": re.escape(q), "$options": "i"}
+        cursor = queries.find({
+            "user_id": request.user_id,
+            "$or": [
+                {"question": pattern},
+                {"text": pattern},
+                {"sources.source": pattern}
+            ]
+        }, {"chunks": 0, "chunk_ids": 0}).sort("created_at", -1)
+    else:
+        cursor = queries.find(
+            {"user_id": request.user_id, "$text": {"$search": q}},
+            {"score": {"$meta": "textScore"}, "chunks": 0, "chunk_ids": 0}
+        ).sort([("score", {"$meta": "textScore"}), ("created_at", -1)])
+
+    results = list(cursor.skip((page - 1) * limit).limit(limit))
 
     for item in results:
         item["_id"] = str(item["_id"])
@@ -292,18 +589,20 @@ def search_history():
 @app.route("/api/history/<question>", methods=["DELETE"])
 @require_auth
 def delete_history_item(question):
-    result = queries.delete_one({
-        "question": {"$regex": f"^{question}$", "$options": "i"},
-        "user_id": request.user_id
-    })
-    if result.deleted_count == 0:
+    item = find_question(request.user_id, question)
+    if not item:
         return jsonify({"error": "Not found"}), 404
+    # The deleted document itself, so the rollup sees whether it had been counted
+    item = queries.find_one_and_delete({"_id": item["_id"]})
+    if item:
+        analytics_rollups.record_delete(item)
     return jsonify({"message": "Deleted"}), 200
 
 @app.route("/api/history", methods=["DELETE"])
 @require_auth
 def delete_all_history():
     queries.delete_many({})
+    analytics_rollups.clear()
     return jsonify({"message": "All history deleted"}), 200
     
 @app.route("/api/upload", methods=["POST"])
@@ -318,20 +617,66 @@ def upload_file():
             return jsonify({"error": "Empty filename"}), 400
 
         filename = secure_filename(file.filename)
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        # Per-user folder so two users uploading "notes.pptx" don't overwrite each other
+        user_folder = os.path.join(UPLOAD_FOLDER, secure_filename(request.user_id))
+        os.makedirs(user_folder, exist_ok=True)
+        filepath = os.path.join(user_folder, filename)
         file.save(filepath)
 
-        # FIX: Pass the user_id to the ingest function
-        ingest_document(filepath, request.user_id) 
+        # Parsing, OCR and embedding run on the job queue; the client polls /api/upload/<job_id>
+        from ingest import ingest_document
+        job_id = job_queue.submit("ingest", request.user_id, ingest_document, filepath, request.user_id)
 
-        return jsonify({"message": "Uploaded"}), 200
+        return jsonify({"message": "Upload queued", "job_id": job_id}), 202
     
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({"error": repr(e)}), 500
+
+@app.route("/api/upload/<job_id>", methods=["GET"])
+@require_auth
+def upload_status(job_id):
+    job = job_queue.get(job_id, request.user_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({
+        "job_id": job["_id"],
+        "status": job["status"],
+        "progress": job.get("progress", {}),
+        "result": job.get("result"),
+        "error": job.get("error")
+    })
+
+@app.route("/api/documents/<filename>", methods=["DELETE"])
+@require_auth
+def delete_uploaded_document(filename):
+    from ingest import delete_document
+    removed = delete_document(secure_filename(filename), request.user_id)
+    if removed == 0:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({"message": "Deleted", "chunks": removed}), 200
         
 
+def apply_feedback(query_id, feedback):
+    # The pre-update document tells the rollup what to undo
+    before = queries.find_one_and_update(
+        {"_id": query_id},
+        {"$set": {"feedback": feedback}},
+        projection={"user_id": 1, "feedback": 1, COUNTED: 1}
+    )
+    if before:
+        analytics_rollups.record_feedback(before, feedback)
+
+def apply_bookmark(query_id, value):
+    before = queries.find_one_and_update(
+        {"_id": query_id},
+        {"$set": {"bookmarked": value}},
+        projection={"user_id": 1, "bookmarked": 1, COUNTED: 1}
+    )
+    if before:
+        analytics_rollups.record_bookmark(before, value)
+
 @app.route("/api/feedback", methods=["POST"])
 @require_auth
 def save_feedback():
@@ -342,10 +687,12 @@ def save_feedback():
     if not msg_id or feedback not in ["up", "down"]:
         return jsonify({"error": "Invalid input"}), 400
 
-    queries.update_one(
-        {"_id": ObjectId(msg_id)},
-        {"$set": {"feedback": feedback}}
-    )
+    writes = get_write_buffer()
+    if writes:
+        # Applied after any queued insert of the same record
+        writes.call(apply_feedback, ObjectId(msg_id), feedback)
+    else:
+        apply_feedback(ObjectId(msg_id), feedback)
 
     return jsonify({"message": "Feedback saved", "feedback": feedback}), 200
 
@@ -359,10 +706,11 @@ def bookmark():
     if not msg_id or value not in [True, False]:
         return jsonify({"error": "Invalid input"}), 400
 
-    queries.update_one(
-        {"_id": ObjectId(msg_id)},
-        {"$set": {"bookmarked": value}}
-    )
+    writes = get_write_buffer()
+    if writes:
+        writes.call(apply_bookmark, ObjectId(msg_id), value)
+    else:
+        apply_bookmark(ObjectId(msg_id), value)
 
     return jsonify({"message": "Bookmark updated", "value": value})
 
@@ -370,97 +718,56 @@ def bookmark():
 @app.route("/api/analytics", methods=["GET"])
 @require_auth
 def analytics():
-    uid = request.user_id
-    
-    total = queries.count_documents({"user_id": uid})
-    helpful = queries.count_documents({"user_id": uid, "feedback": "up"})
-    wrong = queries.count_documents({"user_id": uid, "feedback": "down"})
-    bookmarked = queries.count_documents({"user_id": uid, "bookmarked": True})
-
-    most_questions = list(
-        queries.aggregate([
-            {"$match": {"user_id": uid}},
-            {"$group": {"_id": "$question", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ])
-    )
-
-    most_sources = list(
-        queries.aggregate([
-            {"$match": {"user_id": uid}},
-            {"$unwind": "$sources"},
-            {"$group": {"_id": "$sources.source", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ])
-    )
-
-    hallucination_rate = round((wrong / total) * 100, 2) if total else 0
-
-    return jsonify({
-        "total": total,
-        "helpful": helpful,
-        "wrong": wrong,
-        "bookmarked": bookmarked,
-        "hallucination_rate": hallucination_rate,
-        "top_questions": most_questions,
-        "top_sources": most_sources
-    })
+    # One precomputed document plus two indexed top-5 lookups
+    return jsonify(analytics_rollups.summary(request.user_id))
 
 @app.route("/api/export", methods=["GET"])
 @require_auth
 def export_history_pdf():
-    items = list(queries.find({"user_id": request.user_id}).sort("created_at", 1))
-
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    elements = []
-
-    for item in items:
-        elements.append(Paragraph(f"<b>Q:</b> {item['question']}", styles["Normal"]))
-        elements.append(Paragraph(f"<b>A:</b> {item['text']}", styles["Normal"]))
-
-        if item.get("sources"):
-            srcs = ", ".join(s["source"] for s in item["sources"])
-            elements.append(Paragraph(f"<b>Sources:</b> {srcs}", styles["Normal"]))
-
-        if item.get("feedback"):
-            elements.append(Paragraph(f"<b>Feedback:</b> {item['feedback']}", styles["Normal"]))
-
-        if item.get("bookmarked"):
-            elements.append(Paragraph("<b>⭐ Bookmarked</b>", styles["Normal"]))
+    if request.args.get("async") == "1":
+        # Large histories: render on the job queue, then fetch /api/export/<job_id>
+        export_id = uuid.uuid4().hex
+        job_id = job_queue.submit("export", request.user_id, export_history_job, queries, request.user_id, export_id)
+        return jsonify({"message": "Export queued", "job_id": job_id}), 202
+
+    # Records are read in projected batches and the PDF is streamed from disk,
+    # so neither the history nor the finished file is held in memory
+    return Response(stream_history_pdf(queries, request.user_id), 200, {
+        "Content-Type": "application/pdf",
+        "Content-Disposition": "attachment; filename=chat_history.pdf"
+    })
 
-        elements.append(Spacer(1, 12))
+@app.route("/api/export/<job_id>", methods=["GET"])
+@require_auth
+def export_status(job_id):
+    job = job_queue.get(job_id, request.user_id)
+    if not job or job.get("kind") != "export":
+        return jsonify({"error": "Not found"}), 404
 
-    doc.build(elements)
-    buffer.seek(0)
+    if job["status"] == "done":
+        return send_file(
+            export_path(job["result"]["export_id"]),
+            mimetype="application/pdf",
+            as_attachment=True,
+            download_name="chat_history.pdf"
+        )
 
-    return buffer.getvalue(), 200, {
-        "Content-Type": "application/pdf",
-        "Content-Disposition": "attachment; filename=chat_history.pdf"
-    }
+    return jsonify({
+        "job_id": job["_id"],
+        "status": job["status"],
+        "progress": job.get("progress", {}),
+        "error": job.get("error")
+    })
 
 @app.route("/api/admin/analytics", methods=["GET"])
 @require_auth
 @require_admin
 def admin_analytics():
-    total_users = users.count_documents({})
-    total_queries = queries.count_documents({})
-
-    top_users = list(
-        queries.aggregate([
-            {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-    )
-
+    # Collection metadata counts and the rollups instead of a full $group over queries
     return jsonify({
-        "total_users": total_users,
-        "total_queries": total_queries,
-        "top_users": top_users
+        "total_users": users.estimated_document_count(),
+        "total_queries": queries.estimated_document_count(),
+        "top_users": analytics_rollups.top_users()
     })
 
 @app.route("/api/admin/promote", methods=["POST"])
@@ -473,14 +780,17 @@ def promote():
     if not username:
         return jsonify({"error": "Username required"}), 400
 
-    result = users.update_one(
+    user = users.find_one_and_update(
         {"username": username},
-        {"$set": {"role": "admin"}}
+        {"$set": {"role": "admin"}},
+        projection={"_id": 1}
     )
 
-    if result.matched_count == 0:
+    if not user:
         return jsonify({"error": "User not found"}), 404
 
+    invalidate_role(user["_id"])
+
     return jsonify({"message": f"{username} promoted to admin"})
 
 @app.route("/api/debug/raw_docs", methods=["GET"])
@@ -496,7 +806,9 @@ def debug_raw_docs():
             "error": str(e)
         }), 500
 
-        
+# Reported on /metrics
+STARTUP_SECONDS = round(time.perf_counter() - _import_started, 3)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
 
@@ -1,11 +1,23 @@
 import jwt
+import time
 from datetime import datetime, timezone, timedelta
+from bson import ObjectId
 import os
+from utils.cache import LRUCache
 
 # This line looks for JWT_SECRET in Railway variables. 
 # If not found, it uses the fallback "supersecretkey" (not recommended for production).
 SECRET = os.getenv("JWT_SECRET", "supersecretkey")
 
+# Verified tokens and user roles are cached per worker for a short time.
+# A promotion is visible at once on the worker that handled it and within
+# ROLE_CACHE_TTL seconds everywhere else.
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "300"))
+ROLE_CACHE_TTL = int(os.getenv("ROLE_CACHE_TTL", "60"))
+
+_verified_tokens = LRUCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
+_roles = LRUCache(maxsize=10000, ttl=ROLE_CACHE_TTL)
+
 def create_token(user_id):
     payload = {
         "user_id": str(user_id),
@@ -15,10 +27,30 @@ def create_token(user_id):
     return jwt.encode(payload, SECRET, algorithm="HS256")
 
 def verify_token(token):
+    payload = _verified_tokens.get(token)
+    if payload is not None and payload["exp"] > time.time():
+        return payload
+
     # Uses the SAME SECRET to decode and verify the token
-    return jwt.decode(
+    payload = jwt.decode(
         token,
         SECRET,
         algorithms=["HS256"],
         options={"require": ["exp"]}
     )
+    # Never keep a token cached past its own expiry
+    _verified_tokens.set(token, payload, ttl=min(TOKEN_CACHE_TTL, payload["exp"] - time.time()))
+    return payload
+
+def get_role(users, user_id):
+    """Role of a user ("user"/"admin"), or None if the account doesn't exist."""
+    role = _roles.get(user_id)
+    if role is None:
+        user = users.find_one({"_id": ObjectId(user_id)}, {"role": 1})
+        # "" caches a missing account too, so unknown ids don't hit MongoDB every time
+        role = user.get("role", "user") if user else ""
+        _roles.set(user_id, role)
+    return role or None
+
+def invalidate_role(user_id):
+    _roles.pop(str(user_id))
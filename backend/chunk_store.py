@@ -0,0 +1,61 @@
+import hashlib
+from pymongo import UpdateOne
+
+def chunk_id(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ChunkStore:
+    """
+    Retrieved chunk text stored once, keyed by its content hash, so history
+    records only carry chunk ids. The same slide text retrieved by a hundred
+    questions is one document here instead of a hundred copies in `queries`.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def save(self, texts, writes=None):
+        """
+        Upserts the chunks and returns their ids in the same order. With a
+        db.WriteBuffer the upserts are queued on it instead of sent now.
+        """
+        ids = [chunk_id(t) for t in texts]
+        ops = [
+            UpdateOne({"_id": cid}, {"$setOnInsert": {"text": text}}, upsert=True)
+            for cid, text in dict(zip(ids, texts)).items()
+        ]
+        if writes:
+            for op in ops:
+                writes.write(self.collection, op)
+        elif ops:
+            self.collection.bulk_write(ops, ordered=False)
+        return ids
+
+    def load(self, ids):
+        if not ids:
+            return {}
+        return {c["_id"]: c["text"] for c in self.collection.find({"_id": {"$in": list(set(ids))}})}
+
+    def hydrate(self, items):
+        """
+        Replaces chunk_ids with chunk text on each history item, with one
+        $in lookup for the whole batch. Records from before the chunk store
+        still carry their chunks inline and are left as they are.
+        """
+        texts = self.load([cid for item in items for cid in item.get("chunk_ids", [])])
+        for item in items:
+            ids = item.pop("chunk_ids", None)
+            if ids is not None:
+                item["chunks"] = [texts[cid] for cid in ids if cid in texts]
+        return items
+
+    def collect_garbage(self, queries):
+        """Deletes chunks no history record points at any more (run from cleanup)."""
+        referenced = set()
+        for item in queries.find({"chunk_ids": {"$exists": True}}, {"chunk_ids": 1}):
+            referenced.update(item["chunk_ids"])
+
+        orphans = [c["_id"] for c in self.collection.find({}, {"_id": 1}) if c["_id"] not in referenced]
+        for i in range(0, len(orphans), 1000):
+            self.collection.delete_many({"_id": {"$in": orphans[i:i + 1000]}})
+        return len(orphans)
@@ -1,9 +1,9 @@
 import os
 from datetime import datetime, timezone, timedelta
-from pymongo import MongoClient
+from db import get_db
+from utils.vectorstore import delete_shard
 
-client = MongoClient(os.getenv("MONGO_URI"))
-db = client["chatbot"]
+db = get_db()
 
 def cleanup_inactive_users():
     thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
@@ -18,10 +18,34 @@ def cleanup_inactive_users():
         # 1. Clear their MongoDB docs
         db["raw_docs"].delete_many({"user_id": uid})
         db["queries"].delete_many({"user_id": uid})
+        db["analytics_rollups"].delete_one({"_id": uid})
+        db["analytics_terms"].delete_many({"user_id": uid})
+
+        # 2. Drop their vector shard from disk
+        delete_shard(uid)
         
-        # 2. Remove their metadata
+        # 3. Remove their metadata
         db["user_metadata"].delete_one({"user_id": uid})
         print(f"Cleaned up data for inactive user: {uid}")
 
+def cleanup_orphan_chunks():
+    # History deletes leave shared chunk text behind; drop what nothing references
+    from chunk_store import ChunkStore
+    removed = ChunkStore(db["chunks"]).collect_garbage(db["queries"])
+    print(f"Removed {removed} unreferenced chunks")
+
+def cleanup_old_exports(max_age_hours=24):
+    # Background PDF exports are kept for download until they go stale
+    from export import EXPORT_DIR
+    if not os.path.isdir(EXPORT_DIR):
+        return
+    cutoff = datetime.now(timezone.utc).timestamp() - max_age_hours * 3600
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+
 if __name__ == "__main__":
     cleanup_inactive_users()
+    cleanup_orphan_chunks()
+    cleanup_old_exports()
@@ -0,0 +1,177 @@
+import atexit
+import os
+import queue
+import threading
+from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
+
+DB_NAME = "chatbot"
+
+# One client (and so one connection pool) per process, shared by every module
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+# Write concern for history records: "1" (default), "majority", or "0" for fire-and-forget
+HISTORY_WRITE_CONCERN = os.getenv("HISTORY_WRITE_CONCERN", "1")
+# "sync": requests wait for their history writes. "buffered": writes are queued
+# and applied by a background thread as batched bulk_writes
+HISTORY_WRITES = os.getenv("HISTORY_WRITES", "sync")
+# Seconds the writer waits to gather a batch, and the most writes sent at once
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.05"))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+
+_client = None
+_writes = None
+_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                uri = os.getenv("MONGO_URI")
+                if not uri:
+                    raise RuntimeError("MONGO_URI missing")
+                _client = MongoClient(
+                    uri,
+                    maxPoolSize=MONGO_MAX_POOL_SIZE,
+                    minPoolSize=MONGO_MIN_POOL_SIZE,
+                    serverSelectionTimeoutMS=5000,  # Wait 5 seconds for the DB to wake up
+                    connectTimeoutMS=10000,
+                    directConnection=False,         # Look for the full cluster
+                    retryWrites=True,
+                    retryReads=True
+                )
+    return _client
+
+
+def get_db():
+    return get_client()[DB_NAME]
+
+
+class LazyCollection:
+    """
+    Stands in for get_db()[name] until it is first used, so a module can keep
+    its collections at module level without building the client (and its
+    monitor threads) when it is imported.
+    """
+
+    def __init__(self, name, **options):
+        self._name = name
+        self._options = options
+        self._collection = None
+
+    def _resolve(self):
+        if self._collection is None:
+            collection = get_db()[self._name]
+            self._collection = collection.with_options(**self._options) if self._options else collection
+        return self._collection
+
+    def with_options(self, **options):
+        return LazyCollection(self._name, **{**self._options, **options})
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+
+class LazyDatabase:
+    """get_db() with the same deferral: db["name"] returns a LazyCollection."""
+
+    def __getitem__(self, name):
+        return LazyCollection(name)
+
+    def __getattr__(self, attr):
+        return getattr(get_db(), attr)
+
+
+def history_write_concern():
+    w = HISTORY_WRITE_CONCERN
+    return WriteConcern(w=int(w) if w.isdigit() else w)
+
+
+class WriteBuffer:
+    """
+    Write-behind queue for the hot history paths. Requests enqueue and
+    return; one background thread applies them in batches. Plain writes
+    (history inserts, chunk upserts) never depend on a callback, so each
+    batch sends its writes first, one unordered bulk_write per collection,
+    then runs the callbacks (rollup updates, and feedback/bookmark updates
+    that need the pre-update document) in arrival order. A rating is
+    therefore never applied before the record it rates.
+    """
+
+    def __init__(self, interval=HISTORY_FLUSH_INTERVAL, batch_size=HISTORY_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.errors = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def write(self, collection, op):
+        """Queues one pymongo write model (InsertOne, UpdateOne, ...)."""
+        self._queue.put(("op", collection, op))
+
+    def call(self, fn, *args, **kwargs):
+        self._queue.put(("call", fn, (args, kwargs)))
+
+    def flush(self, timeout=None):
+        """Blocks until everything queued before this call has been applied."""
+        done = threading.Event()
+        self._queue.put(("flush", done, None))
+        return done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                # Let a burst of requests pile up into one round trip
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get(timeout=self.interval))
+            except queue.Empty:
+                pass
+            self._apply(batch)
+
+    def _apply(self, batch):
+        runs = {}      # collection name -> (collection, ops), in first-seen order
+        callbacks = []
+        flushes = []
+        for kind, target, payload in batch:
+            if kind == "op":
+                runs.setdefault(target.full_name, (target, []))[1].append(payload)
+            elif kind == "call":
+                callbacks.append((target, payload))
+            else:
+                flushes.append(target)
+
+        for collection, ops in runs.values():
+            try:
+                collection.bulk_write(ops, ordered=False)
+            except Exception as e:
+                self.errors += 1
+                print(f"History bulk write failed ({len(ops)} ops): {e}")
+        for fn, (args, kwargs) in callbacks:
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self.errors += 1
+                print(f"History write failed: {e}")
+        for done in flushes:
+            done.set()
+
+
+def get_write_buffer():
+    """The process-wide write buffer, or None when history writes are synchronous."""
+    global _writes
+    if HISTORY_WRITES != "buffered":
+        return None
+    if _writes is None:
+        with _lock:
+            if _writes is None:
+                _writes = WriteBuffer()
+                # Don't drop queued history on a clean shutdown
+                atexit.register(_writes.flush, 5)
+    return _writes
@@ -0,0 +1,149 @@
+import os
+import tempfile
+from xml.sax.saxutils import escape
+
+# ReportLab is imported on the first export, not when the app boots
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(BASE_DIR, "exports"))
+# History records pulled from MongoDB (and turned into flowables) at a time
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "200"))
+STREAM_CHUNK_BYTES = 64 * 1024
+
+# Only what ends up on the page; chunks/raw_retrieval never leave MongoDB
+EXPORT_PROJECTION = {"_id": 0, "question": 1, "text": 1, "sources.source": 1, "feedback": 1, "bookmarked": 1}
+
+def item_flowables(item, styles):
+    from reportlab.platypus import Paragraph, Spacer
+
+    elements = [
+        Paragraph(f"<b>Q:</b> {escape(item.get('question', ''))}", styles["Normal"]),
+        Paragraph(f"<b>A:</b> {escape(item.get('text', ''))}", styles["Normal"])
+    ]
+
+    if item.get("sources"):
+        srcs = ", ".join(s.get("source", "") for s in item["sources"])
+        elements.append(Paragraph(f"<b>Sources:</b> {escape(srcs)}", styles["Normal"]))
+
+    if item.get("feedback"):
+        elements.append(Paragraph(f"<b>Feedback:</b> {escape(item['feedback'])}", styles["Normal"]))
+
+    if item.get("bookmarked"):
+        elements.append(Paragraph("<b>⭐ Bookmarked</b>", styles["Normal"]))
+
+    elements.append(Spacer(1, 12))
+    return elements
+
+# SimpleDocTemplate's defaults, which earlier exports used
+PAGE_MARGIN = 72
+
+class _PageWriter:
+    """
+    Lays flowables onto A4 pages with ReportLab's public Frame API
+    (Frame.add / Frame.split) and draws each page as soon as it is full,
+    so a flowable lives only until its page is drawn.
+    """
+
+    def __init__(self, out):
+        from reportlab.lib.pagesizes import A4
+        from reportlab.pdfgen.canvas import Canvas
+
+        self.pagesize = A4
+        self.canvas = Canvas(out, pagesize=A4)
+        self._new_frame()
+
+    def _new_frame(self):
+        from reportlab.platypus import Frame
+
+        width, height = self.pagesize
+        self.frame = Frame(PAGE_MARGIN, PAGE_MARGIN, width - 2 * PAGE_MARGIN, height - 2 * PAGE_MARGIN)
+        self.empty = True
+
+    def add(self, flowable):
+        pending = [flowable]
+        while pending:
+            head = pending.pop(0)
+            if self.frame.add(head, self.canvas, trySplit=1):
+                self.empty = False
+                continue
+            # Split across the page break (a long answer), else start a new page
+            parts = self.frame.split(head, self.canvas)
+            if len(parts) > 1:
+                pending[:0] = parts
+            elif not self.empty:
+                self.canvas.showPage()
+                self._new_frame()
+                pending.insert(0, head)
+            else:
+                print(f"Export: skipped a {type(head).__name__} too large for an empty page")
+
+    def save(self):
+        # An empty history still produces a valid one-page PDF
+        self.canvas.showPage()
+        self.canvas.save()
+
+def write_history_pdf(queries, user_id, out, progress=None):
+    """Renders a user's history into `out` (path or file object), one record at a time."""
+    from reportlab.lib.styles import getSampleStyleSheet
+
+    cursor = (
+        queries.find({"user_id": user_id}, EXPORT_PROJECTION)
+        .sort("created_at", 1)
+        .batch_size(EXPORT_BATCH_SIZE)
+    )
+
+    styles = getSampleStyleSheet()
+    writer = _PageWriter(out)
+    written = 0
+    for item in cursor:
+        for flowable in item_flowables(item, styles):
+            writer.add(flowable)
+        written += 1
+        if progress and written % EXPORT_BATCH_SIZE == 0:
+            progress(items_written=written)
+    writer.save()
+    if progress:
+        progress(items_written=written)
+    return written
+
+def stream_history_pdf(queries, user_id):
+    """
+    Builds the PDF into a temp file and yields it in chunks, deleting the
+    file afterwards, so the finished document is never held in a BytesIO.
+    A PDF ends with its cross-reference table, so nothing can be sent
+    before the whole file is written: time to first byte grows with the
+    history. The web client uses the background export (?async=1) instead.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=EXPORT_DIR)
+    os.close(fd)
+    try:
+        write_history_pdf(queries, user_id, path)
+    except Exception:
+        os.remove(path)
+        raise
+
+    def chunks():
+        try:
+            with open(path, "rb") as f:
+                while True:
+                    data = f.read(STREAM_CHUNK_BYTES)
+                    if not data:
+                        break
+                    yield data
+        finally:
+            os.remove(path)
+
+    return chunks()
+
+def export_path(export_id):
+    return os.path.join(EXPORT_DIR, f"{export_id}.pdf")
+
+def export_history_job(queries, user_id, export_id, progress):
+    """Background variant: writes exports/<export_id>.pdf for the client to download later."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = export_path(export_id)
+    tmp_path = path + ".part"
+    written = write_history_pdf(queries, user_id, tmp_path, progress=progress)
+    os.replace(tmp_path, path)
+    return {"items": written, "export_id": export_id}
@@ -1,19 +1,14 @@
 from utils.loaders import load_file
-from utils.embeddings import get_embeddings
-from langchain_community.vectorstores import FAISS
+from utils.ocr_cache import track_ocr_cache
+from utils.metrics import timed, count
+from utils.embeddings import get_embeddings, EMBEDDING_BATCH_SIZE
+from utils.vectorstore import get_shards, shard_dir, add_documents, delete_documents
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from pymongo import MongoClient
 from datetime import datetime, timezone
 import os
 import re
-
-client = MongoClient(
-    os.getenv("MONGO_URI"),
-    serverSelectionTimeoutMS=5000, # Wait 5 seconds for DB to wake up
-    directConnection=False         # Ensure it looks for the full cluster
-)
-db = client["chatbot"]
-raw_docs = db["raw_docs"]
+import uuid
+import numpy as np
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Force the folder to match the persistent volume mount point exactly
@@ -23,12 +18,25 @@ def extract_questions(text):
     questions = re.findall(r"\d+\..*?\?", text, flags=re.DOTALL)
     return [q.strip() for q in questions]
 
-def ingest_document(file_path, user_id=None):    
+def _no_progress(**fields):
+    pass
+
+def ingest_document(file_path, user_id=None, progress=_no_progress):    
+    """
+    Loads, chunks, embeds and indexes one upload.
+    `progress(**fields)` is called as each stage finishes so a background
+    job can report how far along it is.
+    """
+    progress(stage="loading")
+
     # 1. Load with Slide-Level Precision
     # We must ensure each slide is treated as a separate page to avoid "mashing"
-    from langchain_community.document_loaders import UnstructuredPowerPointLoader
-    loader = UnstructuredPowerPointLoader(file_path, mode="elements", strategy="fast")
-    raw_docs = loader.load()
+    # .pptx decks come back one document per slide, image-only slides OCR'd
+    # in the process pool through the OCR cache
+    with timed("ingest_load"), track_ocr_cache() as ocr_stats:
+        raw_docs = load_file(file_path)
+    pages = {d.metadata.get("page_number", d.metadata.get("page")) for d in raw_docs}
+    progress(stage="splitting", slides_parsed=len(pages), ocr_cache=ocr_stats)
 
     # 2. Optimized Chunking for Technical Content
     # Using a larger chunk size allows the AI to see 'Paragraph Logic' 
@@ -41,7 +49,8 @@ def ingest_document(file_path, user_id=None):
     
     # 3. Add Contextual Metadata
     # This ensures the retriever knows exactly which slide a "type" belongs to
-    docs = text_splitter.split_documents(raw_docs)
+    with timed("ingest_split"):
+        docs = text_splitter.split_documents(raw_docs)
     for doc in docs:
         # Ensure the filename is clean for the UI sources list
         doc.metadata["source"] = os.path.basename(file_path)
@@ -49,13 +58,47 @@ def ingest_document(file_path, user_id=None):
         if "page_number" in doc.metadata:
             doc.metadata["page"] = doc.metadata["page_number"]
 
-    # 4. Create Vector Store with MMR-ready Embeddings
+    if not docs:
+        raise ValueError("No documents to index")
+
+    # 4. Embed only the new chunks (outside the index lock, this is the slow part)
+    source = os.path.basename(file_path)
+    ids = [uuid.uuid4().hex for _ in docs]
+    for doc, chunk_id in zip(docs, ids):
+        doc.metadata["chunk_id"] = chunk_id
+    texts = [doc.page_content for doc in docs]
     embeddings = get_embeddings()
-    vectorstore = FAISS.from_documents(docs, embeddings)
-    
-    # Save locally so get_retriever() can find it
-    vectorstore.save_local("faiss_index")
-    return True
+    progress(stage="embedding", chunks_total=len(texts), chunks_embedded=0)
+
+    batches = []
+    with timed("ingest_embed"):
+        for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            batches.append(embeddings.embed_array(texts[i:i + EMBEDDING_BATCH_SIZE]))
+            progress(chunks_embedded=min(i + EMBEDDING_BATCH_SIZE, len(texts)))
+    count("chunks_embedded", len(texts))
+    vectors = np.vstack(batches)
+    metadatas = [doc.metadata for doc in docs]
+
+    progress(stage="indexing")
+
+    # 5. Publish only the new chunks, as a new segment of the uploader's shard
+    # (or the shared corpus when no user is given). Re-uploading a file marks
+    # its old chunks deleted rather than duplicating them, and every worker's
+    # get_retriever() hot-swaps to the new generation.
+    with timed("ingest_index"):
+        generation, vectorstore = add_documents(
+            ids, texts, metadatas, vectors, replace_source=source, index_dir=shard_dir(user_id)
+        )
+    get_shards().install(user_id, generation, vectorstore)
+    progress(stage="done", index_committed=True, generation=generation)
+    return {"source": source, "chunks": len(docs), "generation": generation, "ocr_cache": ocr_stats}
+
+def delete_document(source, user_id=None):
+    """Removes every chunk of an uploaded file from the index. Returns how many were dropped."""
+    generation, vectorstore, removed = delete_documents(os.path.basename(source), shard_dir(user_id))
+    if vectorstore is not None:
+        get_shards().install(user_id, generation, vectorstore)
+    return removed
 
 
 
@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from pymongo import ASCENDING
+
+# Background workers per web process (ingest is mostly OCR, network and disk)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Queued/running jobs get their updated_at touched this often by the process that owns them
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+# A job whose heartbeat stopped this long ago belonged to a worker that died
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "180"))
+# Job documents are dropped by a TTL index once they stop being updated
+JOB_TTL_HOURS = int(os.getenv("JOB_TTL_HOURS", "24"))
+
+ACTIVE = ("queued", "running")
+
+class JobQueue:
+    """
+    Runs slow work (ingest, exports) on a small thread pool instead of inside
+    the request. Job state lives in MongoDB when a collection is given, so any
+    worker can answer a status poll; otherwise it stays in this process.
+    Threads die with their process, so the owner heartbeats its jobs and a
+    job whose heartbeat went quiet is reported (and stored) as failed.
+    """
+
+    def __init__(self, collection=None, workers=JOB_WORKERS):
+        self.collection = collection
+        self.workers = workers
+        # Threads start with the first job, so importing the app doesn't spawn them
+        self._executor = None
+        self._local = {}
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+                if self.collection is not None:
+                    threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+            return self._executor
+
+    def ensure_indexes(self):
+        if self.collection is not None:
+            self.collection.create_index(
+                [("updated_at", ASCENDING)],
+                expireAfterSeconds=JOB_TTL_HOURS * 3600
+            )
+
+    def submit(self, kind, user_id, fn, *args, **kwargs):
+        """Queues fn(*args, progress=..., **kwargs) and returns the job id right away."""
+        job_id = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        self._save({
+            "_id": job_id,
+            "kind": kind,
+            "user_id": user_id,
+            "status": "queued",
+            "progress": {},
+            "created_at": now,
+            "updated_at": now
+        })
+        with self._lock:
+            self._active.add(job_id)
+        self._start().submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def get(self, job_id, user_id=None):
+        if self.collection is not None:
+            job = self.collection.find_one({"_id": job_id})
+        else:
+            with self._lock:
+                job = dict(self._local[job_id]) if job_id in self._local else None
+        if job is None or (user_id is not None and job.get("user_id") != user_id):
+            return None
+        if self.collection is not None and job["status"] in ACTIVE:
+            self._fail_if_stale(job)
+        return job
+
+    def _fail_if_stale(self, job):
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=JOB_STALE_SECONDS)
+        fields = {
+            "status": "failed",
+            "error": "The worker running this job stopped before it finished",
+            "updated_at": datetime.now(timezone.utc)
+        }
+        # Conditional, so a heartbeat or finish that just landed wins
+        result = self.collection.update_one(
+            {"_id": job["_id"], "status": {"$in": list(ACTIVE)}, "updated_at": {"$lt": cutoff}},
+            {"$set": fields}
+        )
+        if result.modified_count:
+            job.update(fields)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            with self._lock:
+                active = list(self._active)
+            if not active:
+                continue
+            try:
+                self.collection.update_many(
+                    {"_id": {"$in": active}, "status": {"$in": list(ACTIVE)}},
+                    {"$set": {"updated_at": datetime.now(timezone.utc)}}
+                )
+            except Exception as e:
+                print(f"Job heartbeat failed: {e}")
+
+    def _run(self, job_id, fn, args, kwargs):
+        def progress(**fields):
+            self._update(job_id, {f"progress.{k}": v for k, v in fields.items()})
+
+        self._update(job_id, {"status": "running"})
+        try:
+            result = fn(*args, progress=progress, **kwargs)
+            self._update(job_id, {"status": "done", "result": result})
+        except Exception as e:
+            traceback.print_exc()
+            self._update(job_id, {"status": "failed", "error": repr(e)})
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+    def _save(self, job):
+        if self.collection is not None:
+            self.collection.insert_one(job)
+        else:
+            with self._lock:
+                self._local[job["_id"]] = job
+
+    def _update(self, job_id, fields):
+        fields["updated_at"] = datetime.now(timezone.utc)
+        if self.collection is not None:
+            self.collection.update_one({"_id": job_id}, {"$set": fields})
+            return
+        with self._lock:
+            job = self._local.get(job_id)
+            if job is None:
+                return
+            for key, value in fields.items():
+                # Mirror Mongo's dotted "$set" paths for the in-memory copy
+                if key.startswith("progress."):
+                    job["progress"][key[len("progress."):]] = value
+                else:
+                    job[key] = value
@@ -1,58 +1,33 @@
-from huggingface_hub import InferenceClient
-import os
-from utils.llm import call_llm
-from rapidfuzz import fuzz
-import re
-from pymongo import MongoClient
-from langchain.prompts import PromptTemplate
 import os
+from utils.llm import call_llm, stream_llm
 from rag_utils import (
     load_vectorstore,
     get_retriever,
-    truncate_docs,
-    compute_confidence,
-    compute_coverage
+    pack_context,
+    compute_confidence
 )
-
-client = MongoClient(os.getenv("MONGO_URI"))
-db = client["chatbot"]
-raw_docs = db["raw_docs"]
+from utils.metrics import timed, tokens_total
+from utils.grounding import GroundingIndex, StreamingGrounder, ground_answer, GROUNDED_THRESHOLD
 
 def docs_are_relevant(question, docs, threshold=30):
+    """True when at least `threshold` percent of the question's words occur in the docs."""
     if not docs:
         return False
 
-    doc_text = " ".join(d.page_content for d in docs).lower()
-    score = fuzz.partial_ratio(question.lower(), doc_text)
+    return GroundingIndex.from_docs(docs).term_overlap(question) * 100 >= threshold
 
-    return score >= threshold
-
-def extract_grounded_spans(answer, docs, threshold=0.8):
+def extract_grounded_spans(answer, docs, threshold=GROUNDED_THRESHOLD):
     """
     Identifies which parts of the AI answer are directly supported by the documents.
-    Uses identical cleaning logic to the frontend to ensure blue highlights appear.
+    Each sentence is scored against an n-gram index of the retrieved slides,
+    built once, instead of fuzzy-matching it against all of their text.
     """
-    grounded = []
-    
-    # 1. Build a normalized Source of Truth from the retrieved slides
-    # We remove markdown artifacts and standardize whitespace to prevent matching failures.
-    doc_text = " ".join([" ".join(d.page_content.split()) for d in docs]).lower()
-    doc_text = doc_text.replace("*", "").replace("#", "")
-
-    # 2. Split the AI's rephrased answer into individual sentences for verification
-    # We use a 30-character minimum to avoid highlighting generic words like "GANs".
-    sentences = [s.strip() for s in re.split(r'[.!?]', answer) if len(s.strip()) > 30]
-
-    for s in sentences:
-        # 3. Deep Normalize the AI's sentence for comparison
-        clean_s = " ".join(s.lower().split()).replace("*", "").replace("#", "")
-        
-        # 4. Check for direct inclusion or high-confidence fuzzy matching
-        # Fuzzy matching handles minor rephrasing between your slides and the AI answer.
-        if clean_s in doc_text or fuzz.partial_ratio(clean_s, doc_text) >= (threshold * 100):
-            grounded.append(s)
-
-    return grounded, [] # Returning empty list for second return value to keep it simple
+    if not docs:
+        return [], []
+    spans = GroundingIndex.from_docs(docs).spans(answer)
+    grounded = [s["text"] for s in spans if s["score"] >= threshold]
+    general = [s["text"] for s in spans if s["score"] < threshold]
+    return grounded, general
 
 RAG_ANALYSIS_PIPELINE_TEMPLATE = """
 You are a technical AI assistant. Use the following pieces of retrieved context to answer the question. 
@@ -71,51 +46,112 @@ USER QUESTION:
 [DETAILED TECHNICAL ANSWER]
 """.strip()
 
-rag_prompt_custom = PromptTemplate(
-    input_variables=["context_text", "question"],
-    template=RAG_ANALYSIS_PIPELINE_TEMPLATE
-)
+def retrieve(question, user_id=None):
+    """Returns the retrieved docs and the retriever's per-stage timings (ms)."""
+    with timed("shard_lookup"):
+        retriever = get_retriever(user_id)
+    if not retriever:
+        return [], {}
+    docs = retriever.invoke(question)
+    return docs, dict(retriever.timings)
+
+def retrieve_many(questions, user_id=None):
+    """Batched retrieve: one embedding call and one MMR pass per shard for all questions."""
+    retriever = get_retriever(user_id)
+    if not retriever:
+        return [[] for _ in questions], {}
+    results = retriever.search_many(questions)
+    return results, dict(retriever.timings)
+
+def build_prompt(question, docs):
+    """Returns the prompt and the context packing stats (tokens used/saved)."""
+    with timed("prompt_build"):
+        context_text, context_stats = pack_context(docs)
+        # Plain str.format: LangChain's PromptTemplate added nothing but import time
+        prompt = RAG_ANALYSIS_PIPELINE_TEMPLATE.format(
+            context_text=context_text,
+            question=question
+        )
+    tokens_total.inc(context_stats["tokens"], kind="sent")
+    tokens_total.inc(context_stats["tokens_saved"], kind="saved")
+    return prompt, context_stats
+
+def format_sources(docs):
+    return [
+        {
+            "source": os.path.basename(d.metadata.get("source", "Doc")), 
+            "page": d.metadata.get("page", "?")
+        } for d in docs
+    ]
+
+def build_result(docs, answer):
+    # 4. FIX: Removed the "filtered_sentences" logic that was cutting off 
+    # detailed answers. This now returns the full response from the LLM.
+    final_text = answer.strip()
+    
+    # 5. SYNCHRONIZED RETURN FOR FRONTEND
+    # One copy of the chunk text; the debug view reads the same list
+    with timed("grounding"):
+        grounding = ground_answer(docs, final_text)
+    return {
+        "text": final_text,
+        "confidence": compute_confidence(docs),
+        "coverage": grounding["coverage"],
+        "spans": grounding["spans"],
+        "sources": format_sources(docs),
+        "chunks": [d.page_content for d in docs]
+    }
+
+NO_DOCS_RESULT = {"text": "No relevant information found in the documents.", "chunks": []}
 
 def generate_answer(question, mode, memory=None, strict=True, user_id=None): 
     # 2. RETRIEVAL
-    retriever = get_retriever()
-    docs = retriever.invoke(question) if retriever else []
+    docs, timings = retrieve(question, user_id)
 
     if not docs:
-        return {"text": "No relevant information found in the documents.", "chunks": []}
-
-    context_text = truncate_docs(docs)
+        return dict(NO_DOCS_RESULT, timings=timings)
 
     # 3. DYNAMIC PROMPT GENERATION
-    final_prompt = rag_prompt_custom.format(
-        context_text=context_text,
-        question=question
-    )
+    final_prompt, context_stats = build_prompt(question, docs)
     
     # call_llm uses temperature=0.0 for consistency
-    answer = call_llm(final_prompt)
-    
-    # 4. FIX: Removed the "filtered_sentences" logic that was cutting off 
-    # detailed answers. This now returns the full response from the LLM.
-    final_text = answer.strip()
-    
-    # 5. SYNCHRONIZED RETURN FOR FRONTEND
-    raw_chunks = [d.page_content for d in docs]
+    with timed("llm", timings):
+        answer = call_llm(final_prompt)
 
-    return {
-        "text": final_text,
-        "confidence": compute_confidence(docs),
-        "coverage": compute_coverage(docs, final_text),
-        "sources": [
-            {
-                "source": os.path.basename(d.metadata.get("source", "Doc")), 
-                "page": d.metadata.get("page", "?")
-            } for d in docs
-        ],
-        "raw_retrieval": raw_chunks,
-        "chunks": raw_chunks 
-    }
+    return dict(build_result(docs, answer), timings=timings, context=context_stats)
 
+def stream_answer(question, mode, memory=None, strict=True, user_id=None):
+    """
+    Streaming twin of generate_answer. Yields ("sources", ...) as soon as
+    retrieval is done, then ("token", ...) per LLM delta with ("grounding", ...)
+    whenever a sentence completes, and finally ("result", ...) with the same
+    dict generate_answer would have returned.
+    """
+    docs, timings = retrieve(question, user_id)
 
+    if not docs:
+        yield "result", dict(NO_DOCS_RESULT, timings=timings)
+        return
 
+    yield "sources", {
+        "sources": format_sources(docs),
+        "chunks": [d.page_content for d in docs]
+    }
 
+    final_prompt, context_stats = build_prompt(question, docs)
+    # Sentences are scored as soon as they are complete, so coverage fills in live
+    grounder = StreamingGrounder(docs)
+    parts = []
+    with timed("llm", timings):
+        for delta in stream_llm(final_prompt):
+            parts.append(delta)
+            yield "token", {"text": delta}
+            spans = grounder.feed(delta)
+            if spans:
+                yield "grounding", {"spans": spans, "coverage": grounder.coverage()}
+
+    spans = grounder.finish()
+    if spans:
+        yield "grounding", {"spans": spans, "coverage": grounder.coverage()}
+
+    yield "result", dict(build_result(docs, "".join(parts)), timings=timings, context=context_stats)
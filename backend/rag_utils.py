@@ -1,57 +1,232 @@
+import hashlib
 import os
-from langchain_community.vectorstores import FAISS
-from utils.embeddings import get_embeddings
-
-def load_vectorstore():
-    """Loads the FAISS index from the persistent volume."""
-    embeddings = get_embeddings()
-    # Path must match the VECTOR_DIR defined in your ingest.py
-    index_path = os.path.join(os.path.dirname(__file__), "faiss_index")
-    if os.path.exists(index_path):
-        return FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
-    return None
+from contextlib import ExitStack
+from typing import List
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.documents import Document
+from utils.vectorstore import get_shards
+from utils.llm import count_tokens
+from utils.grounding import ground_answer
+from utils.metrics import timed
+
+# Also search the shared corpus (chunks ingested without a user) alongside each user's own shard
+SEARCH_SHARED = os.getenv("SEARCH_SHARED_INDEX", "0") == "1"
+# Fuse BM25 keyword hits with the vector hits (set HYBRID_SEARCH=0 for vectors only)
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+# Reciprocal rank fusion constant; 60 is the usual choice from the RRF paper
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# LLM context budget in model tokens (about what the old 12,000-character cap held)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Same-page chunks sharing at least this many characters are stitched together
+MIN_MERGE_OVERLAP = 30
+# Share of word trigrams already in the context at which a chunk counts as a repeat
+DUPLICATE_SIMILARITY = 0.85
+
+MMR_KWARGS = {
+    "k": 10,            # Number of final chunks to send to LLM
+    "fetch_k": 30,      # Number of chunks to initially pool
+    "lambda_mult": 0.5  # 0.5 is the "sweet spot" for technical diversity
+}
+
+def load_vectorstore(user_id=None):
+    """Returns this worker's cached, mapped shard (reloaded only when ingest publishes a new one)."""
+    return get_shards().get(user_id)
+
+def doc_key(doc):
+    """Identity for fusion; chunks indexed before chunk_id existed fall back to their content."""
+    chunk_id = doc.metadata.get("chunk_id")
+    if chunk_id:
+        return chunk_id
+    raw = f"{doc.metadata.get('source')}\0{doc.page_content}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def reciprocal_rank_fusion(ranked_lists, k=RRF_K):
+    """
+    Scores every chunk by sum(1 / (k + rank)) over the lists it appears in.
+    Ties keep the order the lists were given in, so the user's shard still
+    comes before the shared corpus at equal rank.
+    """
+    scores = {}
+    docs = {}
+    for ranked in ranked_lists:
+        for rank, doc in enumerate(ranked, start=1):
+            key = doc_key(doc)
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+def shard_docs(store, rows):
+    return [store.document(row) for row in rows]
+
+class HybridRetriever(BaseRetriever):
+    """
+    Embeds the questions in one call, then for each shard runs batched MMR
+    over the shard's vector matrix and a BM25 keyword search, and fuses all
+    the ranked lists per question with RRF. Both searches return rows of
+    the shard's mapped columns, which are decoded only for the hits.
+    Stage timings (ms) of the last call are left in `timings`.
+    """
+    stores: list
+    search_kwargs: dict
+    hybrid: bool = True
+    timings: dict = {}
+
+    def _get_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        return self.search_many([query])[0]
+
+    def search_many(self, queries):
+        """Retrieves for several questions at once (query expansion, evaluation runs)."""
+        timings = {}
+
+        with timed("query_embed", timings, "embed"):
+            embeddings = self.stores[0].embedding_function.embed_array(queries)
+
+        # ranked[q] collects one ranked list per shard and per retrieval method
+        ranked = [[] for _ in queries]
+
+        with ExitStack() as stack:
+            # A shard evicted mid-search stays mapped until these reads finish
+            for store in self.stores:
+                stack.enter_context(store.reading())
+
+            with timed("dense_search", timings, "dense"):
+                for store in self.stores:
+                    for lists, rows in zip(ranked, store.vectors.mmr(embeddings, **self.search_kwargs)):
+                        lists.append(shard_docs(store, rows))
+
+            if self.hybrid:
+                with timed("sparse_search", timings, "sparse"):
+                    for store in self.stores:
+                        for lists, query in zip(ranked, queries):
+                            hits = store.bm25.search(query, self.search_kwargs["k"])
+                            lists.append(shard_docs(store, [row for row, _ in hits]))
 
-def get_retriever():
-    vectorstore = load_vectorstore()
-    if not vectorstore:
+        with timed("fuse", timings):
+            fused = [reciprocal_rank_fusion(lists)[:self.search_kwargs["k"]] for lists in ranked]
+
+        self.timings = timings
+        return fused
+
+def get_retriever(user_id=None):
+    stores = [load_vectorstore(user_id)]
+    if user_id is not None and SEARCH_SHARED:
+        stores.append(load_vectorstore(None))
+    stores = [s for s in stores if s]
+    if not stores:
         return None
+    return HybridRetriever(stores=stores, search_kwargs=MMR_KWARGS, hybrid=HYBRID_SEARCH)
     
-    return vectorstore.as_retriever(
-        search_type="mmr", 
-        search_kwargs={
-            "k": 10,            # Number of final chunks to send to LLM
-            "fetch_k": 30,      # Number of chunks to initially pool
-            "lambda_mult": 0.5  # 0.5 is the "sweet spot" for technical diversity
-        }
-    )
-    
-def truncate_docs(docs, max_chars=12000):
+def doc_page(doc, position):
+    # Syncs page numbers for perfect highlighting
+    return (doc.metadata.get("page") or
+            doc.metadata.get("page_number") or
+            doc.metadata.get("index") or
+            position)
+
+def merge_overlap(a, b, min_overlap=MIN_MERGE_OVERLAP):
     """
-    STRUCTURAL TRUNCATION: Prevents logical 'mashing' errors.
-    Ensures the AI sees clear boundaries between GAN architectures.
+    Joins two chunks of the same page when one contains the other or when
+    the end of one repeats as the start of the other (the splitter's
+    chunk_overlap). Returns None when they don't overlap.
+    """
+    if b in a:
+        return a
+    if a in b:
+        return b
+    for first, second in ((a, b), (b, a)):
+        longest = min(len(first), len(second))
+        for size in range(longest, min_overlap - 1, -1):
+            if first.endswith(second[:size]):
+                return first + second[size:]
+    return None
+
+def shingles(text, size=3):
+    words = text.lower().split()
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def pack_context(docs, max_tokens=CONTEXT_TOKEN_BUDGET):
+    """
+    Builds the LLM context from docs in relevance order, measured in model tokens:
+    1. chunks of the same source and page that overlap are merged into one section,
+    2. sections whose text is (nearly) all in a section already taken are dropped,
+    3. sections are added by relevance; one that doesn't fit is skipped,
+       not the end of packing, so smaller later sections can still fill the budget.
+    Returns the context text and stats, including how many tokens were saved.
     """
-    context_parts = []
-    current_length = 0
-
-    for i, doc in enumerate(docs):
-        source = os.path.basename(doc.metadata.get("source", "Unknown"))
-        # Syncs page numbers for perfect highlighting
-        page = (doc.metadata.get("page") or 
-                doc.metadata.get("page_number") or 
-                doc.metadata.get("index") or 
-                (i + 1))
-        content = doc.page_content.strip()
+    # Chunks grouped by (source, page), groups ordered by their best-ranked chunk
+    pages = {}
+    for position, doc in enumerate(docs, start=1):
+        key = (os.path.basename(doc.metadata.get("source", "Unknown")), doc_page(doc, position))
+        pages.setdefault(key, []).append(doc.page_content.strip())
+
+    sections = []
+    merged = 0
+    for (source, page), pieces in pages.items():
+        # Stitch until nothing on the page overlaps any more (chunks arrive out of order)
+        changed = True
+        while changed:
+            changed = False
+            for a in range(len(pieces)):
+                for b in range(a + 1, len(pieces)):
+                    joined = merge_overlap(pieces[a], pieces[b])
+                    if joined is not None:
+                        pieces[a] = joined
+                        del pieces[b]
+                        merged += 1
+                        changed = True
+                        break
+                if changed:
+                    break
+        sections.extend((source, page, content) for content in pieces)
 
+    kept = []
+    duplicates = 0
+    for section in sections:
+        grams = shingles(section[2])
+        # Share of this section's trigrams already in a kept one (catches subsets too)
+        if any(len(grams & other) / len(grams) >= DUPLICATE_SIMILARITY for _, other in kept):
+            duplicates += 1
+            continue
+        kept.append((section, grams))
+
+    parts = []
+    used = 0
+    packed = 0
+    over_budget = 0
+    for (source, page, content), _ in kept:
         # Added structural headers to fix the 'Wrong Answer' logic
         formatted_chunk = f"--- [SLIDE {page} | {source}] ---\n{content}\n"
-        
-        if current_length + len(formatted_chunk) > max_chars:
-            break
-            
-        context_parts.append(formatted_chunk)
-        current_length += len(formatted_chunk)
+        tokens = count_tokens(formatted_chunk)
+        packed += tokens
+        if used + tokens > max_tokens:
+            over_budget += 1
+            continue
+        parts.append(formatted_chunk)
+        used += tokens
+
+    # What the same chunks would have cost one by one, without merging or dedup
+    raw = sum(
+        count_tokens(f"--- [SLIDE {doc_page(doc, i)} | {os.path.basename(doc.metadata.get('source', 'Unknown'))}] ---\n{doc.page_content.strip()}\n")
+        for i, doc in enumerate(docs, start=1)
+    )
+    stats = {
+        "tokens": used,
+        "tokens_budget": max_tokens,
+        "tokens_raw": raw,
+        "tokens_saved": max(raw - packed, 0),
+        "chunks_merged": merged,
+        "duplicates_dropped": duplicates,
+        "sections_over_budget": over_budget
+    }
+    return "\n".join(parts), stats
 
-    return "\n".join(context_parts)
+def truncate_docs(docs, max_tokens=CONTEXT_TOKEN_BUDGET):
+    """
+    STRUCTURAL TRUNCATION: Prevents logical 'mashing' errors.
+    Ensures the AI sees clear boundaries between GAN architectures.
+    """
+    return pack_context(docs, max_tokens)[0]
 
 def compute_confidence(docs):
     """Simple confidence metric based on retrieval success."""
@@ -59,8 +234,7 @@ def compute_confidence(docs):
 
 def compute_coverage(docs, answer):
     """Calculates how much of the answer is supported by retrieved chunks."""
-    # Placeholder for your existing coverage logic
-    return 100 if len(docs) > 0 else 0
+    return ground_answer(docs, answer)["coverage"]
 
 
 
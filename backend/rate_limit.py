@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from pymongo import ReturnDocument
+
+RATE_LIMIT = int(os.getenv("RATE_LIMIT", "20"))
+WINDOW_SECONDS = int(os.getenv("RATE_LIMIT_WINDOW_SECONDS", "60"))
+# "memory" for a single process, "mongo" when several workers must share one budget
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "mongo")
+
+class MemoryRateLimiter:
+    """Sliding window of hit times per user, kept inside this process."""
+
+    def __init__(self, limit=RATE_LIMIT, window=WINDOW_SECONDS):
+        self.limit = limit
+        self.window = window
+        self._hits = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def ensure_indexes(self):
+        pass
+
+    def allow(self, user_id):
+        now = time.monotonic()
+        window_start = now - self.window
+
+        with self._lock:
+            hits = self._hits.setdefault(user_id, deque())
+            while hits and hits[0] < window_start:
+                hits.popleft()
+
+            self._sweep(now, window_start)
+
+            if len(hits) >= self.limit:
+                return False
+            hits.append(now)
+            return True
+
+    def _sweep(self, now, window_start):
+        # Forget idle users once per window so the dict doesn't grow forever
+        if now - self._last_sweep < self.window:
+            return
+        self._last_sweep = now
+        for user_id in [u for u, h in self._hits.items() if not h or h[-1] < window_start]:
+            del self._hits[user_id]
+
+class MongoRateLimiter:
+    """
+    One rate_limits document per user holding the hit times inside the window.
+    A single find_one_and_update (pipeline update) drops expired hits, checks
+    the count and records the new hit atomically, so concurrent workers
+    can't race past the limit. A TTL index on `timestamp` removes idle users.
+    """
+
+    def __init__(self, collection, limit=RATE_LIMIT, window=WINDOW_SECONDS):
+        self.collection = collection
+        self.limit = limit
+        self.window = window
+
+    def ensure_indexes(self):
+        self.collection.create_index("timestamp", expireAfterSeconds=self.window)
+
+    def allow(self, user_id):
+        now = datetime.now(timezone.utc)
+        window_start = now - timedelta(seconds=self.window)
+
+        doc = self.collection.find_one_and_update(
+            {"_id": f"user:{user_id}"},
+            [
+                {"$set": {"hits": {"$filter": {
+                    "input": {"$ifNull": ["$hits", []]},
+                    "cond": {"$gte": ["$$this", window_start]}
+                }}}},
+                {"$set": {"allowed": {"$lt": [{"$size": "$hits"}, self.limit]}}},
+                {"$set": {
+                    "hits": {"$cond": ["$allowed", {"$concatArrays": ["$hits", [now]]}, "$hits"]},
+                    "user_id": user_id,
+                    "timestamp": now
+                }}
+            ],
+            projection={"allowed": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return bool(doc and doc.get("allowed"))
+
+def get_rate_limiter(collection):
+    if RATE_LIMIT_BACKEND == "memory":
+        return MemoryRateLimiter()
+    if RATE_LIMIT_BACKEND == "mongo":
+        return MongoRateLimiter(collection)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {RATE_LIMIT_BACKEND}")
@@ -0,0 +1,139 @@
+import bisect
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+# Words like "gpt-4", "resnet50" or "v1.5" are kept whole and also indexed by their parts
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-_+][a-z0-9]+)*")
+PART_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from how in is it of on or that the this to was what when where which who why with".split()
+)
+
+K1 = 1.5
+B = 0.75
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        parts = PART_RE.findall(token)
+        if len(parts) > 1:
+            tokens.extend(p for p in parts if p not in STOPWORDS)
+    return tokens
+
+
+def build_postings(texts):
+    """
+    Inverted postings for one segment's texts, as the arrays its pack stores:
+      terms + term_offsets   sorted vocabulary, utf-8, term i = terms[off[i]:off[i+1]]
+      postings               term i's entries are rows/tfs[postings[i]:postings[i+1]], rows ascending
+      lengths                token count per row
+    """
+    index = {}
+    lengths = np.zeros(len(texts), dtype=np.int32)
+    for row, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        lengths[row] = sum(counts.values())
+        for term, tf in counts.items():
+            index.setdefault(term, []).append((row, tf))
+
+    terms = sorted(index)
+    encoded = [term.encode("utf-8") for term in terms]
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum([len(term) for term in encoded])
+    postings = np.zeros(len(terms) + 1, dtype=np.int64)
+    postings[1:] = np.cumsum([len(index[term]) for term in terms])
+    entries = [entry for term in terms for entry in index[term]]
+    return {
+        "term_offsets": term_offsets,
+        "terms": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        "postings": postings,
+        "rows": np.array([row for row, _ in entries], dtype=np.int32),
+        "tfs": np.array([tf for _, tf in entries], dtype=np.int32),
+        "lengths": lengths,
+    }
+
+
+class _Terms:
+    """A segment's vocabulary as a sorted sequence of bytes, so bisect can search it in place."""
+
+    def __init__(self, postings):
+        self.postings = postings
+
+    def __len__(self):
+        return len(self.postings.term_offsets) - 1
+
+    def __getitem__(self, i):
+        offsets = self.postings.term_offsets
+        return bytes(self.postings.terms[offsets[i]:offsets[i + 1]])
+
+
+class Postings:
+    """One segment's postings, over arrays shaped like build_postings() returns (mapped or not)."""
+
+    def __init__(self, arrays):
+        self.term_offsets = arrays["term_offsets"]
+        self.terms = arrays["terms"]
+        self.postings = arrays["postings"]
+        self.rows = arrays["rows"]
+        self.tfs = arrays["tfs"]
+        self.lengths = arrays["lengths"]
+
+    def find(self, term):
+        """(rows, tfs) of the term, or None when the segment doesn't contain it."""
+        terms = _Terms(self)
+        i = bisect.bisect_left(terms, term)
+        if i == len(terms) or terms[i] != term:
+            return None
+        start, end = self.postings[i], self.postings[i + 1]
+        return self.rows[start:end], self.tfs[start:end]
+
+
+class BM25:
+    """
+    Okapi BM25 over a shard's segments, with rows numbered across them in
+    order. Like Lucene, document counts and lengths still include deleted
+    rows until their segment is merged; deleted rows are only kept out of
+    the results. Hits are (row, score) pairs.
+    """
+
+    def __init__(self, segments, deleted=(), k1=K1, b=B):
+        self.segments = list(segments)
+        self.bases = np.cumsum([0] + [len(segment.lengths) for segment in self.segments])
+        self.deleted = np.asarray(deleted, dtype=np.int64)
+        self.total_length = sum(int(segment.lengths.sum()) for segment in self.segments)
+        self.k1 = k1
+        self.b = b
+
+    def search(self, query, k=10):
+        """Top-k (row, score) pairs for the query's keywords."""
+        n = int(self.bases[-1])
+        if not n or not self.total_length:
+            return []
+        avg_length = self.total_length / n
+        scores = np.zeros(n, dtype=np.float64)
+        for term in set(tokenize(query)):
+            matches = []
+            for base, segment in zip(self.bases, self.segments):
+                found = segment.find(term.encode("utf-8"))
+                if found is not None:
+                    matches.append((base, segment, *found))
+            df = sum(len(rows) for _, _, rows, _ in matches)
+            if not df:
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for base, segment, rows, tfs in matches:
+                tf = tfs.astype(np.float64)
+                norm = self.k1 * (1 - self.b + self.b * segment.lengths[rows] / avg_length)
+                # Rows are unique within a posting, so plain fancy-index addition is safe
+                scores[base + rows] += idf * tf * (self.k1 + 1) / (tf + norm)
+        scores[self.deleted] = 0
+        hits = np.flatnonzero(scores)
+        top = hits[np.argsort(-scores[hits], kind="stable")[:k]]
+        return [(int(row), float(scores[row])) for row in top]
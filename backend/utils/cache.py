@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU with an optional per-entry TTL (seconds)."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        """Snapshot of live (key, value) pairs, oldest first."""
+        now = time.monotonic()
+        with self._lock:
+            return [(k, v) for k, (v, exp) in self._data.items() if exp is None or exp >= now]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStore:
+    """
+    Tiny persistent key -> bytes table shared by every worker on the box.
+    WAL mode lets one process write while the others keep reading.
+    """
+
+    def __init__(self, path, table="cache"):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        conn = self._connect()
+        found = {}
+        # Stay below SQLite's bound-parameter limit
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders})", batch
+            )
+            found.update(rows)
+        return found
+
+    def set_many(self, items):
+        if not items:
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)", list(items.items())
+            )
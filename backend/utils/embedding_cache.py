@@ -0,0 +1,83 @@
+import hashlib
+import os
+import threading
+import numpy as np
+from utils.cache import LRUCache, SQLiteStore
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Set EMBEDDING_CACHE=0 to always call the model
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE", "1") == "1"
+# Vectors kept in memory per worker (384 floats each, so ~1.5 KB per entry)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "20000"))
+# Empty string keeps the cache in memory only
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join(BASE_DIR, "cache", "embeddings.sqlite3")
+)
+
+def cache_key(model, text):
+    """Content address: the same normalized text under the same model always maps to one key."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """Two tiers: a per-worker LRU in front of an on-disk SQLite table of float32 blobs."""
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, maxsize=EMBEDDING_CACHE_SIZE):
+        self.memory = LRUCache(maxsize)
+        self.disk = SQLiteStore(path, table="embeddings") if path else None
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            vector = self.memory.get(key)
+            if vector is None:
+                missing.append(key)
+            else:
+                found[key] = vector
+
+        if missing and self.disk is not None:
+            for key, blob in self.disk.get_many(missing).items():
+                vector = np.frombuffer(blob, dtype=np.float32)
+                self.memory.set(key, vector)
+                found[key] = vector
+
+        with self._lock:
+            self.disk_hits += len(found) - (len(keys) - len(missing))
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, vectors):
+        for key, vector in vectors.items():
+            self.memory.set(key, vector)
+        if self.disk is not None:
+            self.disk.set_many({
+                key: np.asarray(vector, dtype=np.float32).tobytes()
+                for key, vector in vectors.items()
+            })
+
+    def stats(self):
+        hits = self.memory.hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "memory_entries": len(self.memory),
+        }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_embedding_cache():
+    global _cache
+    if not EMBEDDING_CACHE:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+    return _cache
@@ -1,41 +1,142 @@
 import os
-from huggingface_hub import InferenceClient
 import time
-from huggingface_hub.errors import HfHubHTTPError
+import numpy as np
 from langchain_core.embeddings import Embeddings
+from utils.embedding_cache import cache_key, get_embedding_cache
 
 HF_API_KEY = os.getenv("HF_API_KEY")
 MODEL = "sentence-transformers/paraphrase-MiniLM-L3-v2"
-client = InferenceClient(token=HF_API_KEY)
 
-def embed_texts(texts: list[str]) -> list[list[float]]:
+# "hf" = HuggingFace Inference API, "local" = CPU model inside the worker
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "hf")
+# Ingest sends chunks to the backend in micro-batches of this size
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+# Dynamic int8 quantization of the local model's Linear layers
+EMBEDDING_QUANTIZE = os.getenv("EMBEDDING_QUANTIZE", "0") == "1"
+
+def normalize_text(text):
+    # Same cleanup the frontend highlighter and grounding checks use
+    return " ".join(text.split()).replace("*", "").replace("#", "")
+
+class EmbeddingBackend:
+    """
+    Turns one batch of normalized texts into a float32 (n, dim) array.
+    `name` namespaces the embedding cache, so it must change whenever the
+    backend could return different vectors for the same text.
+    """
+    name = MODEL
+
+    def embed_batch(self, texts: list[str]) -> np.ndarray:
+        raise NotImplementedError
+
+class HFInferenceBackend(EmbeddingBackend):
+    name = f"hf:{MODEL}"
+
+    def __init__(self):
+        from huggingface_hub import InferenceClient
+        self.client = InferenceClient(token=HF_API_KEY)
+
+    def embed_batch(self, texts):
+        from huggingface_hub.errors import HfHubHTTPError
+
+        for attempt in range(3):
+            try:
+                embeddings = self.client.feature_extraction(texts, model=MODEL)
+                return np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
+            except HfHubHTTPError as e:
+                if "504" in str(e) and attempt < 2:
+                    time.sleep(2)
+                    continue
+                raise e
+
+class LocalBackend(EmbeddingBackend):
+    """Runs the model on CPU via sentence-transformers: no network round trip per call."""
+
+    def __init__(self, quantize=EMBEDDING_QUANTIZE):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError("EMBEDDING_BACKEND=local needs `pip install sentence-transformers`") from e
+
+        self.name = f"local{'-int8' if quantize else ''}:{MODEL}"
+        self.model = SentenceTransformer(MODEL, device="cpu")
+        if quantize:
+            import torch
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+    def embed_batch(self, texts):
+        vectors = self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True)
+        return vectors.astype(np.float32, copy=False)
+
+BACKENDS = {
+    "hf": HFInferenceBackend,
+    "local": LocalBackend,
+}
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if EMBEDDING_BACKEND not in BACKENDS:
+            raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+        _backend = BACKENDS[EMBEDDING_BACKEND]()
+    return _backend
+
+def embed_array(texts: list[str], backend=None, batch_size=EMBEDDING_BATCH_SIZE) -> np.ndarray:
+    """
+    Embeds texts in micro-batches and returns a float32 (n, dim) array.
+    Texts already in the embedding cache (and repeats within the call) are
+    not sent to the model again.
+    """
+    backend = backend or get_backend()
     if not texts:
-        return []
-    
+        return np.zeros((0, 0), dtype=np.float32)
+
     # Pre-process texts to match ingestion normalization
-    clean_texts = [" ".join(t.split()).replace("*", "").replace("#", "") for t in texts]
-    
-    for attempt in range(3):
-        try:
-            embeddings = client.feature_extraction(clean_texts, model=MODEL)
-            if hasattr(embeddings, "tolist"):
-                embeddings = embeddings.tolist()
-            if len(embeddings) > 0 and not isinstance(embeddings[0], list):
-                embeddings = [embeddings]
-            return embeddings
-        except HfHubHTTPError as e:
-            if "504" in str(e) and attempt < 2:
-                time.sleep(2)
-                continue
-            raise e
+    clean_texts = [normalize_text(t) for t in texts]
+    keys = [cache_key(backend.name, t) for t in clean_texts]
+
+    cache = get_embedding_cache()
+    vectors = cache.get_many(list(dict.fromkeys(keys))) if cache else {}
+
+    pending = {}
+    for key, text in zip(keys, clean_texts):
+        if key not in vectors:
+            pending[key] = text
+
+    if pending:
+        pending_keys = list(pending)
+        pending_texts = list(pending.values())
+        computed = np.vstack([
+            backend.embed_batch(pending_texts[i:i + batch_size])
+            for i in range(0, len(pending_texts), batch_size)
+        ])
+        fresh = dict(zip(pending_keys, computed))
+        if cache:
+            cache.put_many(fresh)
+        vectors.update(fresh)
+
+    return np.vstack([vectors[key] for key in keys]).astype(np.float32, copy=False)
+
+def embed_texts(texts: list[str]) -> list[list[float]]:
+    return embed_array(texts).tolist()
 
 class HFEmbeddings(Embeddings):
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def embed_array(self, texts):
+        return embed_array(texts, backend=self.backend)
+
     def embed_documents(self, texts):
-        return embed_texts(texts)
+        return self.embed_array(texts).tolist()
 
     def embed_query(self, text):
-        res = embed_texts([text])
-        return res[0] if res else []
+        res = self.embed_array([text])
+        return res[0].tolist() if len(res) else []
 
 def get_embeddings():
     return HFEmbeddings()
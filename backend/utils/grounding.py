@@ -0,0 +1,138 @@
+import re
+from collections import Counter
+
+# Word n-gram length; trigrams survive light rephrasing but not invented facts
+NGRAM = 3
+# Share of a sentence's n-grams found in the chunks for it to count as grounded
+GROUNDED_THRESHOLD = 0.5
+# Shorter sentences ("Yes.", headings) are reported but don't move the percentage
+MIN_SENTENCE_WORDS = 4
+
+_MARKDOWN_RE = re.compile(r"[*_`#>]")
+_WORD_RE = re.compile(r"\w+")
+_SENTENCE_RE = re.compile(r"[^.!?\n]+[.!?]*")
+# A sentence is complete once its terminator is followed by whitespace (or a newline)
+_BOUNDARY_RE = re.compile(r"[.!?](?=\s)|\n")
+
+
+def words(text):
+    return _WORD_RE.findall(_MARKDOWN_RE.sub(" ", text.lower()))
+
+
+def ngrams(tokens, n=NGRAM):
+    if len(tokens) < n:
+        return [tuple(tokens)] if tokens else []
+    return [tuple(tokens[i:i + n]) for i in range(len(tokens) - n + 1)]
+
+
+class GroundingIndex:
+    """
+    Word n-grams of the retrieved chunks, built once per request in one
+    pass over the text. Every answer sentence is then scored by set
+    lookups, linear in the sentence length, instead of fuzzy-matching it
+    against the whole context.
+    """
+
+    def __init__(self, texts, n=NGRAM):
+        self.n = n
+        self.grams = {}       # n-gram -> index of the first chunk containing it
+        self.vocabulary = set()
+        for i, text in enumerate(texts):
+            tokens = words(text)
+            self.vocabulary.update(tokens)
+            for gram in ngrams(tokens, n):
+                self.grams.setdefault(gram, i)
+
+    @classmethod
+    def from_docs(cls, docs):
+        return cls([d.page_content for d in docs])
+
+    def score(self, sentence):
+        """Share of the sentence's n-grams present in the chunks, and the chunk most of them came from."""
+        grams = ngrams(words(sentence), self.n)
+        if not grams:
+            return 0.0, None
+        hits = [self.grams[g] for g in grams if g in self.grams]
+        chunk = Counter(hits).most_common(1)[0][0] if hits else None
+        return len(hits) / len(grams), chunk
+
+    def term_overlap(self, text):
+        """Share of the text's distinct words that appear anywhere in the chunks."""
+        terms = set(words(text))
+        if not terms:
+            return 0.0
+        return len(terms & self.vocabulary) / len(terms)
+
+    def spans(self, text, offset=0):
+        """Scores each sentence of `text`; start/end are character offsets into the full answer."""
+        result = []
+        for match in _SENTENCE_RE.finditer(text):
+            sentence = match.group().strip()
+            if not sentence:
+                continue
+            start = offset + match.start() + (len(match.group()) - len(match.group().lstrip()))
+            score, chunk = self.score(sentence)
+            result.append({
+                "start": start,
+                "end": start + len(sentence),
+                "text": sentence,
+                "score": round(score, 3),
+                "grounded": score >= GROUNDED_THRESHOLD,
+                "chunk": chunk,
+                "words": len(words(sentence))
+            })
+        return result
+
+
+def coverage(spans):
+    """Grounded/general percentages, weighted by sentence length in words."""
+    counted = [s for s in spans if s["words"] >= MIN_SENTENCE_WORDS]
+    total = sum(s["words"] for s in counted)
+    if not total:
+        return {"grounded": 0, "general": 100}
+    grounded = round(100 * sum(s["words"] for s in counted if s["grounded"]) / total)
+    return {"grounded": grounded, "general": 100 - grounded}
+
+
+def ground_answer(docs, answer):
+    """Per-sentence spans plus the grounded/general split for a finished answer."""
+    if not docs:
+        return {"coverage": {"grounded": 0, "general": 100}, "spans": []}
+    spans = GroundingIndex.from_docs(docs).spans(answer)
+    return {"coverage": coverage(spans), "spans": spans}
+
+
+class StreamingGrounder:
+    """
+    Scores an answer while it streams: feed() each delta and get back the
+    sentences it completed, finish() scores whatever is left, and
+    coverage() gives the running grounded/general split.
+    """
+
+    def __init__(self, docs):
+        self.index = GroundingIndex.from_docs(docs)
+        self.text = ""
+        self.all_spans = []
+        self._pos = 0
+
+    def feed(self, delta):
+        self.text += delta
+        last = None
+        for last in _BOUNDARY_RE.finditer(self.text, self._pos):
+            pass
+        if last is None:
+            return []
+        end = last.end()
+        new = self.index.spans(self.text[self._pos:end], offset=self._pos)
+        self._pos = end
+        self.all_spans.extend(new)
+        return new
+
+    def finish(self):
+        new = self.index.spans(self.text[self._pos:], offset=self._pos)
+        self._pos = len(self.text)
+        self.all_spans.extend(new)
+        return new
+
+    def coverage(self):
+        return coverage(self.all_spans)
@@ -0,0 +1,47 @@
+import os
+import re
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# "import time:  self [us] | cumulative | imported package" lines from -X importtime
+_LINE_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def profile_import(module="app", top=20):
+    """
+    Imports `module` in a fresh interpreter with -X importtime and returns
+    (wall seconds, [(cumulative seconds, name), ...]) for the slowest
+    top-level imports, i.e. what booting a worker actually pays for.
+    """
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"import {module} failed")
+
+    costs = {}
+    for line in proc.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        # Depth 0 is the module itself, depth 1 its direct imports
+        if len(indent) // 2 <= 1:
+            costs[name] = max(costs.get(name, 0), int(cumulative) / 1e6)
+    ranked = sorted(((seconds, name) for name, seconds in costs.items()), reverse=True)
+    return wall, ranked[:top]
+
+
+if __name__ == "__main__":
+    # python -m utils.import_profile [module]   (run from backend/)
+    module = sys.argv[1] if len(sys.argv) > 1 else "app"
+    wall, ranked = profile_import(module)
+    print(f"import {module}: {wall:.2f}s wall (including interpreter start)")
+    for seconds, name in ranked:
+        print(f"{seconds * 1000:9.1f} ms  {name}")
@@ -0,0 +1,278 @@
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.documents import Document
+
+from utils.bm25 import BM25, Postings, build_postings
+from utils.vector_search import VECTOR_MMAP, VectorIndex, normalize_rows
+
+# A shard folder holds immutable segments and one small manifest per generation, no pickles:
+#   segments/<name>.bin        one segment's rows packed into a single file, so a single
+#                              mapping (and file descriptor) per segment:
+#                                ids                 chunk id per row (fixed-width bytes)
+#                                texts, metadata     utf-8, row i = bytes[off[i]:off[i+1]],
+#                                                    metadata one JSON object per row
+#                                vectors             unit-length float32 (rows, dim)
+#                                bm25_*              keyword postings (see utils.bm25)
+#   segments/<name>.json       where each array sits in the .bin, and rows per source file
+#   gen-NNNNNN/manifest.json   the generation's segments in row order, each with its deleted rows
+# A generation only lists segments, so publishing one writes just the new rows.
+SEGMENTS_DIR = "segments"
+MANIFEST_FILE = "manifest.json"
+LEGACY_PICKLE = "index.pkl"
+
+
+def is_legacy(folder):
+    """A LangChain save_local() folder whose docstore is a pickle."""
+    return (
+        os.path.exists(os.path.join(folder, LEGACY_PICKLE))
+        and not os.path.exists(os.path.join(folder, MANIFEST_FILE))
+    )
+
+
+def _column(values):
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def write_segment(segments_dir, ids, texts, metadatas, vectors):
+    """
+    Packs rows into a new immutable segment and returns its manifest entry.
+    `metadatas` are dicts, or JSON strings already when segments are merged.
+    """
+    name = f"seg-{uuid.uuid4().hex}"
+    metadatas = [m if isinstance(m, str) else json.dumps(m, default=str) for m in metadatas]
+    encoded_ids = [doc_id.encode("utf-8") for doc_id in ids]
+    width = max((len(i) for i in encoded_ids), default=1)
+
+    arrays = {"ids": np.array(encoded_ids, dtype=f"S{width}")}
+    arrays["texts"], arrays["texts_offsets"] = _column(texts)
+    arrays["metadata"], arrays["metadata_offsets"] = _column(metadatas)
+    arrays["vectors"] = normalize_rows(vectors)
+    arrays.update({f"bm25_{key}": value for key, value in build_postings(texts).items()})
+
+    # Each upload is one contiguous run of rows, so deleting a file is a range lookup
+    sources = {}
+    for row, metadata in enumerate(metadatas):
+        ranges = sources.setdefault(str(json.loads(metadata).get("source")), [])
+        if ranges and ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+
+    os.makedirs(segments_dir, exist_ok=True)
+    layout = {}
+    with open(os.path.join(segments_dir, name + ".bin"), "wb") as f:
+        for key, array in arrays.items():
+            # 8-byte alignment keeps every view a plain typed slice of the mapping
+            f.write(b"\0" * (-f.tell() % 8))
+            layout[key] = [f.tell(), array.dtype.str, list(array.shape)]
+            f.write(np.ascontiguousarray(array).tobytes())
+    with open(os.path.join(segments_dir, name + ".json"), "w", encoding="utf-8") as f:
+        json.dump({"rows": len(ids), "sources": sources, "arrays": layout}, f)
+    return {"name": name, "rows": len(ids), "deleted": []}
+
+
+def read_segment_meta(segments_dir, name):
+    with open(os.path.join(segments_dir, name + ".json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def source_rows(meta, source):
+    """Rows of a segment that came from the given file."""
+    return [row for start, end in meta["sources"].get(source, []) for row in range(start, end)]
+
+
+class _Segment:
+    """One packed segment, mapped read-only; every array is a view of the one mapping."""
+
+    def __init__(self, segments_dir, name):
+        meta = read_segment_meta(segments_dir, name)
+        self.rows = meta["rows"]
+        # Never empty: the offset arrays always hold at least one entry
+        self._data = np.memmap(os.path.join(segments_dir, name + ".bin"), dtype=np.uint8, mode="r")
+        self.arrays = {}
+        for key, (offset, dtype, shape) in meta["arrays"].items():
+            dtype = np.dtype(dtype)
+            size = int(np.prod(shape)) * dtype.itemsize
+            self.arrays[key] = self._data[offset:offset + size].view(dtype).reshape(shape)
+        self.postings = Postings({key[len("bm25_"):]: value for key, value in self.arrays.items() if key.startswith("bm25_")})
+
+    def text(self, column, row):
+        data, offsets = self.arrays[column], self.arrays[column + "_offsets"]
+        return bytes(data[offsets[row]:offsets[row + 1]]).decode("utf-8")
+
+    def close(self):
+        self.arrays = {}
+        self.postings = None
+        data = self.__dict__.pop("_data", None)
+        if data is not None:
+            data._mmap.close()
+
+
+def merge_segments(segments_dir, entries):
+    """Rewrites the live rows of several segments, in order, as one new segment."""
+    ids, texts, metadatas, vectors = [], [], [], []
+    for entry in entries:
+        segment = _Segment(segments_dir, entry["name"])
+        try:
+            live = np.setdiff1d(np.arange(entry["rows"]), entry["deleted"])
+            for row in live:
+                ids.append(segment.arrays["ids"][row].decode("utf-8"))
+                texts.append(segment.text("texts", row))
+                metadatas.append(segment.text("metadata", row))
+            vectors.append(np.array(segment.arrays["vectors"][live]))
+        finally:
+            segment.close()
+    return write_segment(segments_dir, ids, texts, metadatas, np.vstack(vectors))
+
+
+def read_manifest(folder):
+    """The generation's segment entries, oldest first (none for an empty or missing folder)."""
+    path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["segments"]
+
+
+def write_manifest(folder, entries):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({"segments": entries}, f)
+
+
+class _Docstore:
+    """
+    Docstore-style access for code written against FAISS.docstore. It holds
+    the segments rather than the shard, so the two don't form a cycle and a
+    dropped shard is freed (and unmapped) by refcounting alone.
+    """
+
+    def __init__(self, segments, bases, deleted):
+        self.segments = segments
+        self.bases = bases
+        self.deleted = frozenset(deleted)
+
+    def document(self, row):
+        i = int(np.searchsorted(self.bases, row, side="right")) - 1
+        segment, local = self.segments[i], row - self.bases[i]
+        return Document(page_content=segment.text("texts", local), metadata=json.loads(segment.text("metadata", local)))
+
+    def search(self, doc_id):
+        # A scan of the mapped id columns; the query path works in rows and never needs this
+        key = doc_id.encode("utf-8")
+        for base, segment in zip(self.bases, self.segments):
+            for local in np.flatnonzero(segment.arrays["ids"] == key):
+                if base + local not in self.deleted:
+                    return self.document(int(base + local))
+        return None
+
+
+class MappedShard:
+    """
+    Read-only view of one published generation for the query path.
+    Each segment is one memory-mapped file, so opening a shard costs the
+    same however big it is and every worker shares the pages through the
+    OS cache. Documents are decoded by row, only when retrieved.
+
+    Each mapped segment holds a file descriptor, so an evicted shard is
+    closed rather than left to the garbage collector. Reads go through
+    reading(): close() unmaps once the last reader is done, and a shard
+    read after closing maps its files again.
+    """
+
+    def __init__(self, folder, embedding_function):
+        self.folder = folder
+        self.embedding_function = embedding_function
+        self._readers = 0
+        self._closing = False
+        self._lock = threading.Lock()
+        self._map()
+
+    def _map(self):
+        entries = read_manifest(self.folder)
+        segments_dir = os.path.join(os.path.dirname(self.folder), SEGMENTS_DIR)
+        self.segments = [_Segment(segments_dir, entry["name"]) for entry in entries]
+        bases = np.cumsum([0] + [segment.rows for segment in self.segments])
+        deleted = [int(base) + row for base, entry in zip(bases, entries) for row in entry["deleted"]]
+
+        blocks = [segment.arrays["vectors"] for segment in self.segments]
+        if not VECTOR_MMAP:
+            blocks = [np.array(block) for block in blocks]
+        self.vectors = VectorIndex(blocks, deleted)
+        self.bm25 = BM25([segment.postings for segment in self.segments], deleted)
+        # Stands in for FAISS.docstore so retrieval code works on either
+        self.docstore = _Docstore(self.segments, bases, deleted)
+        self.closed = False
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def document(self, row):
+        return self.docstore.document(row)
+
+    @contextmanager
+    def reading(self):
+        """Keeps the files mapped for the duration of a read."""
+        with self._lock:
+            if self.closed:
+                self._map()
+            self._readers += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._readers -= 1
+                if self._closing and not self._readers:
+                    self._unmap()
+
+    def close(self):
+        """Unmaps the files now, or when the last reader finishes."""
+        with self._lock:
+            self._closing = True
+            if not self._readers:
+                self._unmap()
+
+    def _unmap(self):
+        if self.closed:
+            return
+        for segment in self.segments:
+            segment.close()
+        # Anything touching a closed mapping would crash the process, so drop every handle to them
+        self.segments = self.vectors = self.bm25 = self.docstore = None
+        self.closed = True
+
+    def nbytes(self):
+        # Only private heap counts against the cache budget; mapped pages are shared
+        vectors = self.vectors
+        if vectors is None or VECTOR_MMAP:
+            return 0
+        return sum(block.nbytes for block in vectors.blocks)
+
+
+def open_shard(folder, embedding_function):
+    if not os.path.exists(os.path.join(folder, MANIFEST_FILE)):
+        return None
+    return MappedShard(folder, embedding_function)
+
+
+def read_legacy(folder, embedding_function):
+    """
+    Rows of a pickled save_local() folder as (ids, texts, metadatas, vectors),
+    read through LangChain's pickle loader one last time.
+    """
+    from langchain_community.vectorstores import FAISS
+
+    store = FAISS.load_local(folder, embedding_function, allow_dangerous_deserialization=True)
+    index = store.index
+    ids = [store.index_to_docstore_id[i] for i in range(index.ntotal)]
+    docs = [store.docstore.search(doc_id) for doc_id in ids]
+    vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, index.d), dtype=np.float32)
+    return ids, [d.page_content for d in docs], [d.metadata for d in docs], vectors
@@ -1,12 +1,66 @@
 import os
-from groq import Groq
+import re
+import threading
 
-_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+MODEL = "llama-3.1-8b-instant"
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+
+# Built on first use: the Groq SDK and tiktoken are slow to import and
+# most requests (history, analytics, auth) never talk to the model
+_client = None
+_encoding = None
+_lock = threading.Lock()
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                from groq import Groq
+                _client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+    return _client
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        with _lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:  # Optional (and needs its BPE file); the estimate below is close enough for budgeting
+                    _encoding = False
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    """
+    Prompt size in model tokens. Uses tiktoken when it is installed,
+    otherwise counts words and punctuation, adding a token for every
+    4 characters past the first 4 of a long word (BPE splits those).
+    """
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text))
+    return sum(1 + max(len(piece) - 4, 0) // 4 for piece in _PIECE_RE.findall(text))
 
 def call_llm(prompt: str) -> str:
-    completion = _client.chat.completions.create(
-        model="llama-3.1-8b-instant",
+    completion = get_client().chat.completions.create(
+        model=MODEL,
         messages=[{"role": "user", "content": prompt}],
         temperature=0.0,
     )
     return completion.choices[0].message.content
+
+def stream_llm(prompt: str):
+    """Yields the completion text piece by piece as Groq produces it."""
+    stream = get_client().chat.completions.create(
+        model=MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.0,
+        stream=True,
+    )
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
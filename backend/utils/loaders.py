@@ -1,38 +1,143 @@
 import os
 import io
-import pytesseract
-from PIL import Image
-from pptx import Presentation
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
 from langchain_core.documents import Document
-from langchain_community.document_loaders import (
-    PyPDFLoader,
-    Docx2txtLoader,
-    UnstructuredPowerPointLoader
-)
+from utils.ocr_cache import get_ocr_cache, ocr_key
+from utils.metrics import timed, count
+
+# File parsers (pypdf, docx2txt, python-pptx, PIL, pytesseract) are imported
+# by the loader that needs them, so only the formats actually uploaded load
 
 # --- CRITICAL RAILWAY FIX ---
 # Remove the Windows-specific Tesseract path. 
 # On Linux (Railway), the binary will be found automatically in the system PATH.
 # ----------------------------
 
+# OCR runs in a separate process pool so image-heavy decks use every core
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Seconds one image may spend in Tesseract before it is skipped
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "30"))
+OCR_CONFIG = "--psm 6"
+OCR_THRESHOLD = 140
+
+# Lookup table instead of a per-pixel Python lambda
+_BINARIZE_LUT = [0 if x < OCR_THRESHOLD else 255 for x in range(256)]
+# Part of the OCR cache key: changing preprocessing or config must not reuse old text
+OCR_VARIANT = f"binarize<{OCR_THRESHOLD}|{OCR_CONFIG}"
+
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
 def load_file(file_path):
     ext = os.path.splitext(file_path)[1].lower()
 
     if ext == ".pdf":
+        from langchain_community.document_loaders import PyPDFLoader
         return PyPDFLoader(file_path).load()
     elif ext == ".docx":
+        from langchain_community.document_loaders import Docx2txtLoader
         return Docx2txtLoader(file_path).load()
-    elif ext in [".ppt", ".pptx"]:
+    elif ext == ".pptx":
+        # Slide text plus OCR of image-only slides (pooled and cached)
         return load_pptx_with_pages(file_path)
+    elif ext == ".ppt":
+        # Legacy binary decks: python-pptx can't open them, Unstructured converts them
+        from langchain_community.document_loaders import UnstructuredPowerPointLoader
+        return UnstructuredPowerPointLoader(file_path, mode="elements", strategy="fast").load()
     elif ext in [".png", ".jpg", ".jpeg"]:
         return load_image_with_ocr(file_path)
     else:
         raise ValueError(f"Unsupported file type: {ext}")
 
+def binarize(image):
+    """Grayscale + hard threshold, the pre-processing every OCR path uses."""
+    return image.convert("L").point(_BINARIZE_LUT, "1")
+
+def _tesseract(image_bytes):
+    """Top-level (picklable) so it can run inside the OCR process pool. None means it failed."""
+    try:
+        import pytesseract
+        from PIL import Image
+
+        image = binarize(Image.open(io.BytesIO(image_bytes)))
+        # Tesseract itself is killed after OCR_TIMEOUT, so a bad image can't hang a worker
+        return pytesseract.image_to_string(image, config=OCR_CONFIG, timeout=OCR_TIMEOUT)
+    except Exception:
+        return None
+
+def get_ocr_pool():
+    global _ocr_pool
+    if _ocr_pool is None:
+        with _ocr_pool_lock:
+            if _ocr_pool is None:
+                # spawn, not fork: this process runs Flask and job threads, and a
+                # forked child could inherit a lock some other thread was holding
+                _ocr_pool = ProcessPoolExecutor(
+                    max_workers=OCR_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+    return _ocr_pool
+
+def _run_tesseract(images):
+    if len(images) <= 1 or OCR_WORKERS <= 1:
+        return [_tesseract(b) for b in images]
+
+    futures = [get_ocr_pool().submit(_tesseract, b) for b in images]
+    texts = []
+    for i, future in enumerate(futures):
+        try:
+            # Small grace period on top of Tesseract's own timeout for queueing
+            texts.append(future.result(timeout=OCR_TIMEOUT + 5))
+        except FutureTimeout:
+            future.cancel()
+            print(f"DEBUG: OCR timed out on image {i + 1}")
+            texts.append(None)
+        except Exception as e:
+            print(f"DEBUG: Failed to OCR image {i + 1}: {e}")
+            texts.append(None)
+    return texts
+
+def ocr_many(images):
+    """
+    OCRs a list of image blobs; results come back in input order.
+    Images already in the OCR cache (or repeated within the deck, like a
+    logo on every slide) are not sent to Tesseract again.
+    """
+    cache = get_ocr_cache()
+    keys = [ocr_key(b, OCR_VARIANT) for b in images]
+    known = cache.get_many(list(dict.fromkeys(keys))) if cache else {}
+
+    pending = {}
+    for key, image_bytes in zip(keys, images):
+        if key not in known:
+            pending[key] = image_bytes
+
+    texts = []
+    if pending:
+        with timed("ocr"):
+            texts = _run_tesseract(list(pending.values()))
+        count("ocr_images", len(pending))
+    # Failures and timeouts are not cached so they get retried next time
+    fresh = {key: text for key, text in zip(pending, texts) if text is not None}
+    if cache and fresh:
+        cache.put_many(fresh)
+    known.update(fresh)
+
+    return [known.get(key, "") for key in keys]
+
+def ocr_image_bytes(image_bytes):
+    return ocr_many([image_bytes])[0]
+
 def load_pptx_with_pages(file_path):
+    from pptx import Presentation
+
     prs = Presentation(file_path)
-    documents = []
-    
+    slides = []
+    images = []
+
+    # Pass 1: collect slide text and queue OCR work across the whole deck
     for i, slide in enumerate(prs.slides):
         combined_text = []
         has_text = False
@@ -45,15 +150,30 @@ def load_pptx_with_pages(file_path):
             # THE SPEED FIX: Only run OCR if the slide has very little or no text
             elif shape.shape_type == 13 and not has_text: 
                 try:
-                    image_bytes = shape.image.blob
-                    image_stream = io.BytesIO(image_bytes)
-                    image_doc = load_image_with_ocr_from_stream(image_stream)
-                    if image_doc[0].page_content.strip():
-                        combined_text.append(f"[Image Content: {image_doc[0].page_content}]")
+                    # Placeholder index into `images`, filled in after the pool finishes
+                    combined_text.append(len(images))
+                    images.append(shape.image.blob)
                 except Exception as e:
-                    print(f"DEBUG: Failed to OCR image on slide {i+1}: {e}")
+                    combined_text.pop()
+                    print(f"DEBUG: Failed to read image on slide {i+1}: {e}")
 
-        content = "\n".join(combined_text)
+        slides.append(combined_text)
+
+    # Pass 2: OCR everything at once, then reassemble in slide order
+    ocr_texts = ocr_many(images)
+
+    documents = []
+    for i, combined_text in enumerate(slides):
+        parts = []
+        for part in combined_text:
+            if isinstance(part, int):
+                text = ocr_texts[part]
+                if text.strip():
+                    parts.append(f"[Image Content: {text}]")
+            else:
+                parts.append(part)
+
+        content = "\n".join(parts)
 
         if content.strip():
             documents.append(Document(
@@ -63,13 +183,7 @@ def load_pptx_with_pages(file_path):
     return documents
 
 def load_image_with_ocr_from_stream(image_stream):
-    try:
-        image = Image.open(image_stream).convert("L")
-        image = image.point(lambda x: 0 if x < 140 else 255, '1')
-        text = pytesseract.image_to_string(image, config="--psm 6")
-        return [Document(page_content=text)]
-    except:
-        return [Document(page_content="")]
+    return [Document(page_content=ocr_image_bytes(image_stream.read()))]
         
 def load_image_with_ocr(image_path):
     if os.path.getsize(image_path) > 3_000_000:
@@ -77,11 +191,9 @@ def load_image_with_ocr(image_path):
 
     try:
         # Pre-processing for better OCR
-        image = Image.open(image_path).convert("L")
-        image = image.point(lambda x: 0 if x < 140 else 255, '1')
-
-        # Tesseract will be called via the Linux system binary
-        text = pytesseract.image_to_string(image, config="--psm 6")
+        with open(image_path, "rb") as f:
+            # Tesseract will be called via the Linux system binary (unless the cache has it)
+            text = ocr_image_bytes(f.read())
 
         text = text.encode("utf-8", errors="ignore").decode("utf-8")
         text = "".join(c for c in text if c.isprintable())
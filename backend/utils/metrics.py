@@ -0,0 +1,167 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Add a Server-Timing header with this request's stage breakdown
+SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "0") == "1"
+
+# Seconds; covers a cache hit (~1 ms) up to a slow Groq call or OCR'd deck
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_request_stages = contextvars.ContextVar("request_stages", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels_text(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_labels_text(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_labels_text(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_labels_text(key)} {round(series[-2], 6)}")
+                lines.append(f"{self.name}_count{_labels_text(key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics for this worker process, rendered in the Prometheus text format.
+    Collectors are called at scrape time for numbers other modules already
+    keep (cache hit counts, resident shard bytes).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, **kwargs)
+            return metric
+
+    def counter(self, name, help_text):
+        return self._get(Counter, name, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def register_collector(self, fn):
+        """fn() returns [(name, type, help, value, labels dict), ...]."""
+        self._collectors.append(fn)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                samples = collect()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+                continue
+            seen = set()
+            for name, kind, help_text, value, labels in samples:
+                if name not in seen:
+                    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                    seen.add(name)
+                lines.append(f"{name}{_labels_text(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+stage_seconds = REGISTRY.histogram("rag_stage_seconds", "Time spent per pipeline stage")
+events_total = REGISTRY.counter("rag_events_total", "Pipeline events (rate limited, chunks embedded, ...)")
+tokens_total = REGISTRY.counter("rag_prompt_tokens_total", "Prompt context tokens sent and saved by packing")
+http_seconds = REGISTRY.histogram("http_request_seconds", "Request handling time by endpoint")
+
+
+def count(event, amount=1):
+    events_total.inc(amount, event=event)
+
+
+@contextmanager
+def timed(stage, timings=None, key=None):
+    """
+    Times a block into rag_stage_seconds{stage=...} and, when a request is
+    being traced, into its Server-Timing breakdown. If a dict is given the
+    duration is also stored there as "<key or stage>_ms".
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(seconds, stage=stage)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages.append((stage, seconds))
+        if timings is not None:
+            timings[f"{key or stage}_ms"] = round(seconds * 1000, 2)
+
+
+def start_request():
+    _request_stages.set([])
+
+
+def request_stages():
+    return _request_stages.get() or []
+
+
+def server_timing_header(stages):
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages)
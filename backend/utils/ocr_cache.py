@@ -0,0 +1,94 @@
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from utils.cache import LRUCache, SQLiteStore
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Set OCR_CACHE=0 to always run Tesseract
+OCR_CACHE = os.getenv("OCR_CACHE", "1") == "1"
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", os.path.join(BASE_DIR, "cache", "ocr.sqlite3"))
+
+_tracking = threading.local()
+
+def ocr_key(image_bytes, variant):
+    """Same pixels + same preprocessing/Tesseract settings always give the same text."""
+    digest = hashlib.sha256(image_bytes)
+    digest.update(b"\0" + variant.encode("utf-8"))
+    return digest.hexdigest()
+
+class OcrCache:
+    def __init__(self, path=OCR_CACHE_PATH, maxsize=2000):
+        self.memory = LRUCache(maxsize)
+        self.disk = SQLiteStore(path, table="ocr") if path else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            text = self.memory.get(key)
+            if text is None:
+                missing.append(key)
+            else:
+                found[key] = text
+
+        if missing and self.disk is not None:
+            for key, blob in self.disk.get_many(missing).items():
+                text = blob.decode("utf-8")
+                self.memory.set(key, text)
+                found[key] = text
+
+        self._record(hits=len(found), misses=len(keys) - len(found))
+        return found
+
+    def put_many(self, texts):
+        for key, text in texts.items():
+            self.memory.set(key, text)
+        if self.disk is not None:
+            self.disk.set_many({key: text.encode("utf-8") for key, text in texts.items()})
+
+    def _record(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+        stats = getattr(_tracking, "stats", None)
+        if stats is not None:
+            stats["hits"] += hits
+            stats["misses"] += misses
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+@contextmanager
+def track_ocr_cache():
+    """Collects hit/miss counts for OCR done on this thread (one ingest job)."""
+    stats = {"hits": 0, "misses": 0}
+    previous = getattr(_tracking, "stats", None)
+    _tracking.stats = stats
+    try:
+        yield stats
+    finally:
+        _tracking.stats = previous
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / total, 4) if total else 0.0
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_ocr_cache():
+    global _cache
+    if not OCR_CACHE:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = OcrCache()
+    return _cache
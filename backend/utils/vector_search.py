@@ -0,0 +1,89 @@
+import os
+import numpy as np
+
+# Search the mapped vectors in place instead of copying them, so workers share the pages
+VECTOR_MMAP = os.getenv("VECTOR_MMAP", "1") == "1"
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VectorIndex:
+    """
+    Unit-length float32 vectors, one (n, dim) block per index segment, with
+    rows numbered across the blocks in order. Similarity is one matrix
+    product per block and MMR runs over a whole batch of queries at once
+    instead of a Python loop per query. Deleted rows never match.
+    """
+
+    def __init__(self, blocks, deleted=()):
+        # Any 2-D arrays work, including views of a mapped segment
+        self.blocks = list(blocks)
+        self.bases = np.cumsum([0] + [len(block) for block in self.blocks])
+        self.deleted = np.asarray(deleted, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.bases[-1]) - len(self.deleted)
+
+    def take(self, rows):
+        """Vectors for an array of rows, gathered from whichever blocks hold them."""
+        rows = np.asarray(rows)
+        dim = self.blocks[0].shape[1]
+        out = np.empty(rows.shape + (dim,), dtype=np.float32)
+        owner = np.searchsorted(self.bases, rows, side="right") - 1
+        for i, block in enumerate(self.blocks):
+            mask = owner == i
+            if mask.any():
+                out[mask] = block[rows[mask] - self.bases[i]]
+        return out
+
+    def search(self, queries, k=10):
+        """Top-k rows per query: (q, k) index and score arrays, best first."""
+        queries = normalize_rows(np.atleast_2d(queries))
+        k = min(k, len(self))
+        if k <= 0:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        scores = np.hstack([queries @ block.T for block in self.blocks])
+        scores[:, self.deleted] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def mmr(self, queries, k=10, fetch_k=30, lambda_mult=0.5):
+        """
+        Maximal marginal relevance for a batch of queries. Returns one list
+        of row indices per query. Each of the k selection steps is a handful of
+        array operations over all queries and candidates together.
+        """
+        candidates, relevance = self.search(queries, fetch_k)
+        batch, pool = candidates.shape
+        if pool == 0:
+            return [[] for _ in range(batch)]
+        k = min(k, pool)
+
+        cand_vectors = self.take(candidates)                                 # (q, pool, dim)
+        redundancy = np.einsum("qid,qjd->qij", cand_vectors, cand_vectors)  # (q, pool, pool)
+
+        rows = np.arange(batch)
+        selected = np.zeros((batch, k), dtype=np.int64)
+        chosen = np.zeros((batch, pool), dtype=bool)
+        max_redundancy = np.full((batch, pool), -np.inf, dtype=np.float32)
+
+        for step in range(k):
+            if step == 0:
+                # Nothing selected yet: the most relevant candidate goes first
+                score = relevance.copy()
+            else:
+                score = lambda_mult * relevance - (1 - lambda_mult) * max_redundancy
+            score[chosen] = -np.inf
+            pick = np.argmax(score, axis=1)
+            selected[:, step] = pick
+            chosen[rows, pick] = True
+            max_redundancy = np.maximum(max_redundancy, redundancy[rows, pick])
+
+        return np.take_along_axis(candidates, selected, axis=1).tolist()
@@ -0,0 +1,413 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from utils.embeddings import get_embeddings
+from utils.index_format import (
+    SEGMENTS_DIR,
+    is_legacy,
+    merge_segments,
+    open_shard,
+    read_legacy,
+    read_manifest,
+    read_segment_meta,
+    source_rows,
+    write_manifest,
+    write_segment,
+)
+from utils.metrics import timed
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: fall back to the in-process lock only
+    fcntl = None
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Single source of truth for where the index lives (ingest writes, rag_utils reads)
+INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join(BASE_DIR, "faiss_index"))
+# Per-user shards, plus an optional shared corpus that only ingest without a user writes to.
+# The root itself may still hold the pre-sharding index, which mixed every user's uploads
+# with no record of whose they were; it is never read, and can be deleted by hand.
+USERS_DIR = os.path.join(INDEX_DIR, "users")
+SHARED_DIR = os.path.join(INDEX_DIR, "shared")
+
+# Memory budget for loaded shards; cold users are evicted first
+CACHE_BUDGET_MB = float(os.getenv("VECTOR_CACHE_MB", "512"))
+# Cap on loaded shards regardless of memory: mapped pages barely count against the
+# budget, but each shard keeps one descriptor open per segment (merging keeps that
+# near log2 of its uploads), so 64 shards stay inside the usual ulimit -n of 1024
+CACHE_MAX_SHARDS = int(os.getenv("VECTOR_CACHE_SHARDS", "64"))
+# A segment with more than this share of its rows deleted is rewritten without them
+SEGMENT_PURGE_RATIO = 0.5
+
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = ".lock"
+
+_publish_lock = threading.Lock()
+
+
+def shard_dir(user_id=None):
+    """Index folder for a user's shard, or the shared corpus when user_id is None."""
+    if user_id is None:
+        return SHARED_DIR
+    user_id = str(user_id)
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", user_id):
+        user_id = hashlib.sha256(user_id.encode()).hexdigest()
+    return os.path.join(USERS_DIR, user_id)
+
+
+def read_generation(index_dir=SHARED_DIR):
+    """Returns the published generation, or 0 for a legacy flat index (or none at all)."""
+    try:
+        with open(os.path.join(index_dir, CURRENT_FILE)) as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def generation_path(index_dir, generation):
+    # Generation 0 is the old layout where index.faiss/index.pkl sit directly in the folder
+    if generation == 0:
+        return index_dir
+    return os.path.join(index_dir, f"gen-{generation:06d}")
+
+
+@contextmanager
+def index_lock(index_dir=SHARED_DIR):
+    """Serializes writers across threads and (where fcntl exists) across worker processes."""
+    os.makedirs(index_dir, exist_ok=True)
+    with _publish_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(index_dir, LOCK_FILE), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def segments_dir(index_dir):
+    return os.path.join(index_dir, SEGMENTS_DIR)
+
+
+def update_vectorstore(update, index_dir=SHARED_DIR):
+    """
+    Read-modify-publish under the writer lock.
+    `update` receives the current generation's segment entries (oldest
+    first, see index_format) and returns the list to publish, or None to
+    leave the index untouched. Returns the new generation and a mapped
+    reader for it.
+    """
+    with index_lock(index_dir):
+        previous = _migrate_locked(index_dir, read_generation(index_dir))
+        segments = update(read_manifest(generation_path(index_dir, previous)))
+        if segments is None:
+            return previous, None
+        with timed("index_publish"):
+            generation = _publish_locked(index_dir, previous, _merge(index_dir, segments))
+    return generation, open_shard(generation_path(index_dir, generation), get_embeddings())
+
+
+def add_documents(ids, texts, metadatas, vectors, replace_source=None, index_dir=SHARED_DIR):
+    """
+    Publishes chunks as a new segment after the shard's existing ones. Only
+    the new rows are written: earlier segments are shared with the previous
+    generation, and chunks of `replace_source` already in the shard are
+    marked deleted rather than rewritten. Returns (generation, mapped reader).
+    """
+    def append(segments):
+        if replace_source is not None:
+            delete_source(index_dir, segments, replace_source)
+        return segments + [write_segment(segments_dir(index_dir), ids, texts, metadatas, vectors)]
+
+    return update_vectorstore(append, index_dir)
+
+
+def delete_documents(source, index_dir=SHARED_DIR):
+    """
+    Marks every chunk of a file deleted in a new generation.
+    Returns (generation, mapped reader or None if nothing matched, chunks removed).
+    """
+    removed = 0
+
+    def drop(segments):
+        nonlocal removed
+        removed = delete_source(index_dir, segments, source)
+        return segments if removed else None
+
+    generation, shard = update_vectorstore(drop, index_dir)
+    return generation, shard, removed
+
+
+def delete_source(index_dir, segments, source):
+    """Adds the rows that came from the given file to each entry's deleted rows. Returns how many."""
+    removed = 0
+    for entry in segments:
+        rows = set(source_rows(read_segment_meta(segments_dir(index_dir), entry["name"]), source))
+        rows -= set(entry["deleted"])
+        if rows:
+            entry["deleted"] = sorted(set(entry["deleted"]) | rows)
+            removed += len(rows)
+    return removed
+
+
+def _live(entry):
+    return entry["rows"] - len(entry["deleted"])
+
+
+def _merge(index_dir, segments):
+    """
+    Keeps the segment count logarithmic in the shard size. The newest
+    segment is merged into the one before it while it holds at least half
+    as many live rows, like a carry in a binary counter, so each row is
+    rewritten O(log n) times over its life and an upload's amortized cost
+    stays proportional to its own size. Segments that are mostly deleted
+    rows are rewritten without them, and fully deleted ones dropped.
+    """
+    folder = segments_dir(index_dir)
+    segments = [
+        merge_segments(folder, [entry]) if len(entry["deleted"]) > entry["rows"] * SEGMENT_PURGE_RATIO else entry
+        for entry in segments if _live(entry)
+    ]
+    while len(segments) > 1 and 2 * _live(segments[-1]) >= _live(segments[-2]):
+        segments[-2:] = [merge_segments(folder, segments[-2:])]
+    return segments
+
+
+def _publish_locked(index_dir, previous, segments):
+    # The manifest is written to a temp folder and renamed into place,
+    # so readers only ever see a complete generation
+    generation = previous + 1
+    tmp_dir = os.path.join(index_dir, f".tmp-{uuid.uuid4().hex}")
+    write_manifest(tmp_dir, segments)
+    os.replace(tmp_dir, generation_path(index_dir, generation))
+
+    # Atomic pointer swap: write the new number aside, then rename over CURRENT
+    tmp_pointer = os.path.join(index_dir, f".{CURRENT_FILE}-{uuid.uuid4().hex}")
+    with open(tmp_pointer, "w") as f:
+        f.write(str(generation))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_pointer, os.path.join(index_dir, CURRENT_FILE))
+
+    # Keep the previous generation around for workers that are still loading it
+    _prune_generations(index_dir, keep={generation, previous})
+    return generation
+
+
+def delete_shard(user_id):
+    """Removes a user's shard folder with every generation in it."""
+    index_dir = shard_dir(user_id)
+    if not os.path.isdir(index_dir):
+        return False
+    with index_lock(index_dir):
+        # Workers that still have it mapped keep reading their copy until they evict it
+        shutil.rmtree(index_dir, ignore_errors=True)
+    return True
+
+
+def _prune_generations(index_dir, keep):
+    for name in os.listdir(index_dir):
+        if not name.startswith("gen-"):
+            continue
+        try:
+            number = int(name[len("gen-"):])
+        except ValueError:
+            continue
+        if number not in keep:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+    # Segments no kept generation lists anymore (merged away, or fully deleted)
+    referenced = {
+        entry["name"]
+        for number in keep
+        for entry in read_manifest(generation_path(index_dir, number))
+    }
+    folder = segments_dir(index_dir)
+    for name in os.listdir(folder) if os.path.isdir(folder) else []:
+        if os.path.splitext(name)[0] not in referenced:
+            os.remove(os.path.join(folder, name))
+
+
+def estimate_nbytes(vectorstore):
+    """Private heap held by a loaded shard."""
+    return vectorstore.nbytes() if vectorstore is not None else 0
+
+
+def _migrate_locked(index_dir, generation):
+    if not is_legacy(generation_path(index_dir, generation)):
+        return generation
+    ids, texts, metadatas, vectors = read_legacy(generation_path(index_dir, generation), get_embeddings())
+    segments = [write_segment(segments_dir(index_dir), ids, texts, metadatas, vectors)] if ids else []
+    return _publish_locked(index_dir, generation, segments)
+
+
+def migrate_legacy(index_dir=SHARED_DIR):
+    """
+    Republishes a pickled (save_local) generation in the mapped format.
+    Returns the generation that is current afterwards.
+    """
+    with index_lock(index_dir):
+        return _migrate_locked(index_dir, read_generation(index_dir))
+
+
+def open_generation(index_dir, generation):
+    """Mapped reader for a generation as (generation, shard), migrating legacy pickles first."""
+    if is_legacy(generation_path(index_dir, generation)):
+        generation = migrate_legacy(index_dir)
+    return generation, open_shard(generation_path(index_dir, generation), get_embeddings())
+
+
+def migrate_all():
+    """One-off: convert the shared corpus and every user shard ahead of time."""
+    dirs = [SHARED_DIR]
+    if os.path.isdir(USERS_DIR):
+        dirs += [os.path.join(USERS_DIR, name) for name in os.listdir(USERS_DIR)]
+    for index_dir in dirs:
+        if is_legacy(generation_path(index_dir, read_generation(index_dir))):
+            print(f"Migrated {index_dir} to generation {migrate_legacy(index_dir)}")
+
+
+class VectorStoreManager:
+    """
+    Keeps the shard open (memory-mapped) once per worker process.
+    Every lookup compares the in-memory generation against CURRENT; when ingest
+    publishes a new one, it is loaded on a background thread and swapped in,
+    so requests keep answering from the old store instead of waiting.
+    """
+
+    def __init__(self, index_dir=SHARED_DIR):
+        self.index_dir = index_dir
+        # (generation, store) is replaced as one tuple so readers never see a mix
+        self._state = (None, None)
+        self._reload_lock = threading.Lock()
+
+    @property
+    def generation(self):
+        return self._state[0]
+
+    @property
+    def nbytes(self):
+        # Measured live: a mapped shard only holds heap when VECTOR_MMAP=0 copies its vectors
+        return estimate_nbytes(self._state[1])
+
+    def get(self):
+        generation, store = self._state
+        published = read_generation(self.index_dir)
+        if published == generation:
+            return store
+
+        if store is None:
+            # Nothing to serve yet, so the first caller loads and the rest wait for it
+            with self._reload_lock:
+                if self._state[0] != published:
+                    self._load(published)
+            return self._state[1]
+
+        if self._reload_lock.acquire(blocking=False):
+            threading.Thread(target=self._reload, args=(published,), daemon=True).start()
+        return store
+
+    def install(self, generation, store):
+        """Lets the worker that just published skip reloading its own index from disk."""
+        with self._reload_lock:
+            if self._state[0] is None or generation > self._state[0]:
+                self._swap(generation, store)
+            elif store is not None:
+                store.close()
+
+    def close(self):
+        """Unmaps the loaded shard (once in-flight searches on it finish)."""
+        self._swap(None, None)
+
+    def _reload(self, generation):
+        try:
+            self._load(generation)
+        except Exception as e:
+            print(f"Vector store reload failed for generation {generation}: {e}")
+        finally:
+            self._reload_lock.release()
+
+    def _load(self, generation):
+        with timed("shard_load"):
+            generation, store = open_generation(self.index_dir, generation)
+        self._swap(generation, store)
+
+    def _swap(self, generation, store):
+        previous = self._state[1]
+        self._state = (generation, store)
+        if previous is not None and previous is not store:
+            previous.close()
+
+
+class ShardCache:
+    """
+    LRU of per-user VectorStoreManagers (user_id None is the shared corpus).
+    After each lookup the least recently used shards are closed and dropped
+    until the loaded ones fit in both the memory budget and the shard cap;
+    an evicted shard is simply reloaded from disk the next time its user
+    asks something.
+    """
+
+    def __init__(self, budget_bytes=CACHE_BUDGET_MB * 1024 * 1024, max_shards=CACHE_MAX_SHARDS):
+        self.budget_bytes = budget_bytes
+        self.max_shards = max_shards
+        self._managers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _manager(self, user_id):
+        with self._lock:
+            manager = self._managers.get(user_id)
+            if manager is None:
+                manager = VectorStoreManager(shard_dir(user_id))
+                self._managers[user_id] = manager
+            self._managers.move_to_end(user_id)
+            return manager
+
+    def get(self, user_id=None):
+        store = self._manager(user_id).get()
+        self._evict()
+        return store
+
+    def generation(self, user_id=None):
+        return read_generation(shard_dir(user_id))
+
+    def install(self, user_id, generation, store):
+        self._manager(user_id).install(generation, store)
+        self._evict()
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(m.nbytes for m in self._managers.values())
+
+    def _evict(self):
+        with self._lock:
+            total = sum(m.nbytes for m in self._managers.values())
+            # Never evict the shard that was just used (it is last in the LRU order)
+            while (
+                (total > self.budget_bytes or len(self._managers) > self.max_shards)
+                and len(self._managers) > 1
+            ):
+                user_id, manager = self._managers.popitem(last=False)
+                nbytes = manager.nbytes
+                total -= nbytes
+                manager.close()
+                print(f"Evicted vector shard for {user_id or 'shared corpus'} ({nbytes} bytes)")
+
+
+_shards = ShardCache()
+
+
+def get_shards():
+    return _shards
+
+
+if __name__ == "__main__":
+    migrate_all()
@@ -152,6 +152,37 @@ async function toggleBookmark(id, value) {
   }
 }
 
+// The server fails jobs whose worker died; this is only a backstop
+const UPLOAD_JOB_TIMEOUT_MS = 20 * 60 * 1000;
+
+async function waitForUploadJob(jobId) {
+  const deadline = Date.now() + UPLOAD_JOB_TIMEOUT_MS;
+  while (true) {
+    if (Date.now() > deadline) {
+      setProcessPhase("");
+      throw new Error("Upload is taking too long; check your documents again later");
+    }
+    await new Promise(resolve => setTimeout(resolve, 1500));
+    const res = await fetch(`${API}/api/upload/${jobId}`, {
+      headers: authHeaders()
+    });
+    const job = await res.json();
+    if (!res.ok) throw new Error(job.error || "Upload status unavailable");
+
+    const p = job.progress || {};
+    if (p.chunks_total) {
+      setProcessPhase(`📥 Processing upload: ${p.chunks_embedded || 0}/${p.chunks_total} chunks embedded`);
+    } else if (p.stage) {
+      setProcessPhase(`📥 Processing upload: ${p.stage}...`);
+    }
+
+    if (job.status === "done" || job.status === "failed") {
+      setProcessPhase("");
+      return job;
+    }
+  }
+}
+
 async function uploadFile(e) {
   const file = e.target.files[0];
   if (!file) return;
@@ -180,8 +211,14 @@ async function uploadFile(e) {
       throw new Error(data.error || "Upload failed");
     }
 
+    // Ingest runs in the background: poll the job until the index is committed
+    const job = await waitForUploadJob(data.job_id);
+    if (job.status === "failed") {
+      throw new Error(job.error || "Processing failed");
+    }
+
     // --- THE FIX STARTS HERE ---
-    alert(data.message || "Uploaded successfully!");
+    alert("Uploaded successfully!");
     
     // 1. Clear the file input so the filename disappears from the UI
     e.target.value = null; 
@@ -202,6 +239,48 @@ async function uploadFile(e) {
 }
   
 
+// Exports render on the job queue: the PDF can't be sent until it is complete,
+// so polling with progress beats a download that sits silent on a long history
+const EXPORT_JOB_TIMEOUT_MS = 10 * 60 * 1000;
+
+async function exportHistory() {
+  try {
+    setProcessPhase("📄 Preparing PDF export...");
+    const res = await fetch(`${API}/api/export?async=1`, {
+      headers: authHeaders()
+    });
+    const queued = await res.json();
+    if (!res.ok) throw new Error(queued.error || "Export failed");
+
+    const deadline = Date.now() + EXPORT_JOB_TIMEOUT_MS;
+    while (true) {
+      if (Date.now() > deadline) throw new Error("Export is taking too long; try again later");
+      await new Promise(resolve => setTimeout(resolve, 1500));
+
+      const poll = await fetch(`${API}/api/export/${queued.job_id}`, {
+        headers: authHeaders()
+      });
+      if ((poll.headers.get("Content-Type") || "").includes("application/pdf")) {
+        const url = URL.createObjectURL(await poll.blob());
+        const link = document.createElement("a");
+        link.href = url;
+        link.download = "chat_history.pdf";
+        link.click();
+        URL.revokeObjectURL(url);
+        return;
+      }
+
+      const job = await poll.json();
+      if (!poll.ok || job.status === "failed") throw new Error(job.error || "Export failed");
+      setProcessPhase(`📄 Exporting: ${(job.progress || {}).items_written || 0} items written...`);
+    }
+  } catch (err) {
+    alert("Export failed: " + err.message);
+  } finally {
+    setProcessPhase("");
+  }
+}
+
 async function loadHistoryItem(id) {
   const res = await fetch(`${API}/api/history/id/${id}`, {
     headers: authHeaders()
@@ -242,6 +321,24 @@ async function loadHistoryPanel() {
   setShowHistoryPanel(true);
 }
 
+// Below this length the text index has no whole word to match
+const HISTORY_TEXT_SEARCH_MIN_LENGTH = 3;
+
+async function searchHistory(q) {
+  const search = async (mode) => {
+    const res = await fetch(`${API}/api/history/search?q=${encodeURIComponent(q)}${mode ? `&mode=${mode}` : ""}`, {
+      headers: authHeaders()
+    });
+    const data = await res.json();
+    return Array.isArray(data) ? data : [];
+  };
+
+  // Ranked text-index search first; short or partial words ("resn") it can't
+  // match fall back to substring matching
+  const ranked = q.trim().length >= HISTORY_TEXT_SEARCH_MIN_LENGTH ? await search() : [];
+  return ranked.length ? ranked : search("substring");
+}
+
 async function deleteHistoryItem(q) {
   if (!window.confirm("Delete this item?")) return;
 
@@ -275,6 +372,10 @@ async function ask() {
   const currentQuestion = question; // Store locally for the fetch
   setQuestion("");
 
+  // Cleared in `finally` too, so a request that fails early can't bring the phase back
+  let analysisTimer;
+  let understandingTimer;
+
   try {
     // --- START HUMAN-LIKE PIPELINE ---
     
@@ -283,17 +384,17 @@ async function ask() {
     
     // Use timeouts to simulate the real time a human takes to analyze parts
     // Phase 2: Analyzing
-    const analysisTimer = setTimeout(() => {
+    analysisTimer = setTimeout(() => {
         setProcessPhase("🧐 Analyzing every part of the document structure...");
     }, 1200);
     
     // Phase 3: Understanding
-    const understandingTimer = setTimeout(() => {
+    understandingTimer = setTimeout(() => {
         setProcessPhase("🧠 Understanding the technical context and logic...");
     }, 2800);
 
-    // 2. Perform the actual backend request
-    const res = await fetch(`${API}/api/ask`, {
+    // 2. Perform the actual backend request (streamed as Server-Sent Events)
+    const res = await fetch(`${API}/api/ask/stream`, {
       method: "POST",
       headers: authHeaders(),
       body: JSON.stringify({ 
@@ -304,34 +405,82 @@ async function ask() {
       }) 
     });
 
-    // Clear simulated timers once real data returns
-    clearTimeout(analysisTimer);
-    clearTimeout(understandingTimer);
-
-    const data = await res.json();
-    if (!res.ok) throw new Error(data.error || "Server error");
+    if (!res.ok) {
+      const data = await res.json();
+      throw new Error(data.error || "Server error");
+    }
 
-    setProcessPhase("✅ Finalizing synchronized answer...");
+    // 3. Show the answer as it is generated, then swap in the highlighted version
+    const streamKey = Date.now();
+    let answer = "";
+    let chunks = [];
+    let started = false;
+
+    const updateBot = (fields) =>
+      setMessages(prev => prev.map(m => (m.streamKey === streamKey ? { ...m, ...fields } : m)));
+
+    const startBot = () => {
+      if (started) return;
+      started = true;
+      clearTimeout(analysisTimer);
+      clearTimeout(understandingTimer);
+      setProcessPhase("✍️ Writing the answer...");
+      setMessages(prev => [...prev, {
+        streamKey,
+        role: "bot",
+        text: "",
+        feedback: null,
+        bookmarked: false
+      }]);
+    };
 
-    // 3. Construct the bot message with high-quality highlights
-    const botMessage = {
-      id: data.id,
-      role: "bot",
-      text: highlightSources(data.text, data.chunks), // Syncs highlights with document
-      confidence: data.confidence,
-      coverage: data.coverage,
-      sources: data.sources,
-      chunks: data.chunks,
-      raw_retrieval: data.raw_retrieval,
-      feedback: null,
-      bookmarked: false      
+    const handleEvent = (event, payload) => {
+      if (event === "error") throw new Error(payload.error || "Server error");
+      startBot();
+
+      if (event === "sources") {
+        chunks = payload.chunks || [];
+        updateBot({ sources: payload.sources, chunks, raw_retrieval: chunks });
+      } else if (event === "token") {
+        answer += payload.text;
+        updateBot({ text: highlightSources(answer, []) });
+      } else if (event === "grounding") {
+        updateBot({ coverage: payload.coverage });
+      } else if (event === "done") {
+        updateBot({
+          id: payload.id,
+          text: highlightSources(payload.text, chunks), // Syncs highlights with document
+          confidence: payload.confidence,
+          coverage: payload.coverage,
+          sources: payload.sources
+        });
+      }
     };
 
-    setMessages(prev => [...prev, botMessage]);
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      // SSE events are separated by a blank line
+      const blocks = buffer.split("\n\n");
+      buffer = blocks.pop();
+      for (const block of blocks) {
+        const event = (block.match(/^event: (.*)$/m) || [])[1];
+        const data = (block.match(/^data: (.*)$/m) || [])[1];
+        if (event && data) handleEvent(event, JSON.parse(data));
+      }
+    }
 
   } catch (err) {
     setMessages(prev => [...prev, { role: "bot", text: `⚠️ Error during analysis: ${err.message}` }]);
   } finally {
+    clearTimeout(analysisTimer);
+    clearTimeout(understandingTimer);
     setLoading(false);
     setProcessPhase(""); // Reset for next interaction
   }
@@ -517,7 +666,7 @@ if (!token || token === "undefined" || token === "null" || token.length < 10) {
         </button>
 
         <button
-          onClick={() => window.open(`${API}/api/export?token=${localStorage.getItem("token")}`, "_blank")}
+          onClick={exportHistory}
           style={{ 
             marginLeft: "10px",
             padding: "10px 20px",
@@ -661,7 +810,7 @@ if (!token || token === "undefined" || token === "null" || token.length < 10) {
           </div>
           ))}
 
-          {loading && (
+          {(loading || processPhase) && (
             <div style={{ display: "flex", justifyContent: "flex-start", marginBottom: "10px" }}>
               <div style={{
                 padding: "12px 18px",
@@ -715,11 +864,7 @@ if (!token || token === "undefined" || token === "null" || token.length < 10) {
                 loadHistoryPanel();
                 return;
               }
-              const res = await fetch(`${API}/api/history/search?q=${encodeURIComponent(q)}`, {
-                headers: authHeaders()
-              });
-              const data = await res.json();
-              setHistoryItems(data);
+              setHistoryItems(await searchHistory(q));
             }}
             style={{
               width: "100%",